@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# Micro-benchmarks for scripts/all_network_speedtest.py
+#
+# Not an RMM script, run it locally when changing the speedtest engine:
+#
+#   python bench/all_network_speedtest_benchmark.py distance --servers 20000
+#   python bench/all_network_speedtest_benchmark.py loopback --rate 1000 --latency 10
+#
+# loopback runs full tests against all_network_speedtest_server.py in a
+# separate process, so nothing reaches speedtest.net and the CPU time and
+# memory measured are those of the speedtest engine alone
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import sys
+import time
+import timeit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import all_network_speedtest_server
+
+SPEEDTEST = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "scripts",
+    "all_network_speedtest.py",
+)
+
+
+def load_speedtest():
+    spec = importlib.util.spec_from_file_location("all_network_speedtest", SPEEDTEST)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@contextlib.contextmanager
+def loopback(speedtest, url):
+    """Rewrite the speedtest.net URLs requested by ``speedtest`` to the
+    loopback server at ``url`` within the block, restoring
+    ``build_request`` on the way out
+    """
+    build_request = speedtest.build_request
+
+    def loopback_request(target, *args, **kwargs):
+        for prefix in (
+            "://www.speedtest.net",
+            "http://www.speedtest.net",
+            "https://www.speedtest.net",
+            "http://c.speedtest.net",
+        ):
+            if target.startswith(prefix):
+                target = url + target[len(prefix) :]
+                break
+        return build_request(target, *args, **kwargs)
+
+    speedtest.build_request = loopback_request
+    try:
+        yield
+    finally:
+        speedtest.build_request = build_request
+
+
+def bench_distance(speedtest, args):
+    """Closest server selection: distance() into a dict keyed by distance,
+    sorted (the previous get_servers/get_closest_servers), against the
+    array backed ServerIndex
+    """
+    rnd = random.Random(args.seed)
+    origin = (40.0, -75.0)
+    servers = [
+        {
+            "id": str(i),
+            "lat": "%.4f" % rnd.uniform(-90, 90),
+            "lon": "%.4f" % rnd.uniform(-180, 180),
+        }
+        for i in range(args.servers)
+    ]
+
+    def legacy():
+        by_distance = {}
+        for attrib in servers:
+            d = speedtest.distance(origin, (float(attrib["lat"]), float(attrib["lon"])))
+            by_distance.setdefault(d, []).append(attrib)
+        closest = []
+        for d in sorted(by_distance.keys()):
+            for s in by_distance[d]:
+                closest.append(s)
+                if len(closest) == args.limit:
+                    return closest
+        return closest
+
+    def build_index():
+        index = speedtest.ServerIndex()
+        for attrib in servers:
+            index.add(
+                int(attrib["id"]), float(attrib["lat"]), float(attrib["lon"]), attrib
+            )
+        return index
+
+    def indexed():
+        return build_index().closest(origin, args.limit)
+
+    index = build_index()
+    index.distances(origin)
+
+    def cached():
+        return index.closest(origin, args.limit)
+
+    assert [s["id"] for s in legacy()] == [s["id"] for s in indexed()]
+
+    print(
+        "%d servers, closest %d, best of %d" % (args.servers, args.limit, args.repeat)
+    )
+    for name, func in (
+        ("distance() + sort", legacy),
+        ("ServerIndex", indexed),
+        ("ServerIndex, cached distances", cached),
+    ):
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print("  %-30s %9.3f ms" % (name, best * 1000))
+
+
+# Engine, download and upload keyword arguments of each scenario
+LOOPBACK_SCENARIOS = {
+    "threads": ("threads", {}, {}),
+    "keep-alive": ("threads", {"keep_alive": True}, {"keep_alive": True}),
+    "shared-payload": (
+        "threads",
+        {"keep_alive": True},
+        {"keep_alive": True, "shared_payload": True},
+    ),
+    "asyncio": ("asyncio", {}, {}),
+}
+
+
+def serve_loopback(port, rate, latency, length):
+    server = all_network_speedtest_server.make_server(
+        port=port, rate=rate, latency=latency, length=length
+    )
+    server.serve_forever()
+
+
+def run_loopback(url, scenario, results):
+    """Run a download and upload test of ``scenario`` against the loopback
+    server at ``url``, putting the throughput and resource use on
+    ``results``
+    """
+    speedtest = load_speedtest()
+    engine_name, download, upload = LOOPBACK_SCENARIOS[scenario]
+
+    with loopback(speedtest, url):
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        tester = speedtest.Speedtest()
+        engine = None
+        if engine_name == "asyncio":
+            engine = speedtest.AsyncioEngine(tester)
+        (engine or tester).get_best_server()
+        (engine or tester).download(**download)
+        (engine or tester).upload(**upload)
+        cpu = time.process_time() - cpu
+        wall = time.perf_counter() - wall
+
+    rss = None
+    if resource:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        if sys.platform == "darwin":
+            rss //= 1024
+    transferred = tester.results.bytes_received + tester.results.bytes_sent
+    results.put(
+        {
+            "download": tester.results.download,
+            "upload": tester.results.upload,
+            "bytes": transferred,
+            "cpu": cpu,
+            "cpu_per_gb": cpu / (transferred / 1e9) if transferred else None,
+            "wall": wall,
+            "max_rss": rss,
+        }
+    )
+
+
+def bench_loopback(speedtest, args):
+    """Full download and upload tests of each scenario against the loopback
+    server, each run in a fresh process, reporting the medians of the
+    achieved throughput, CPU time and peak RSS
+    """
+    rate = args.rate * 1000 * 1000 / 8
+    context = multiprocessing.get_context("spawn")
+    server = context.Process(
+        target=serve_loopback,
+        args=(args.port, rate, args.latency / 1000.0, args.length),
+        daemon=True,
+    )
+    server.start()
+    url = "http://127.0.0.1:%d" % args.port
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", args.port), 1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    print(
+        "loopback rate %s, latency %g ms, %d s tests, median of %d"
+        % (
+            args.rate and "%g Mbit/s" % args.rate or "unlimited",
+            args.latency,
+            args.length,
+            args.repeat,
+        )
+    )
+    print(
+        "  %-16s %12s %12s %8s %10s %10s"
+        % ("scenario", "down Mbit/s", "up Mbit/s", "cpu s", "cpu s/GB", "rss MB")
+    )
+    report = {}
+    try:
+        for scenario in args.scenario or sorted(LOOPBACK_SCENARIOS):
+            if scenario == "asyncio" and speedtest.asyncio is None:
+                continue
+            runs = []
+            for _ in range(args.repeat):
+                results = context.Queue()
+                process = context.Process(
+                    target=run_loopback, args=(url, scenario, results)
+                )
+                process.start()
+                runs.append(results.get())
+                process.join()
+            summary = dict(
+                (key, statistics.median(run[key] for run in runs))
+                for key in runs[0]
+                if None not in [run[key] for run in runs]
+            )
+            report[scenario] = summary
+            shaped = ""
+            if args.rate:
+                shaped = " (%d%%, %d%% of shaped)" % (
+                    summary["download"] / 1e6 / args.rate * 100,
+                    summary["upload"] / 1e6 / args.rate * 100,
+                )
+            print(
+                "  %-16s %12.1f %12.1f %8.2f %10s %10s%s"
+                % (
+                    scenario,
+                    summary["download"] / 1e6,
+                    summary["upload"] / 1e6,
+                    summary["cpu"],
+                    "cpu_per_gb" in summary and "%.2f" % summary["cpu_per_gb"] or "-",
+                    "max_rss" in summary and "%.1f" % (summary["max_rss"] / 1e6) or "-",
+                    shaped,
+                )
+            )
+    finally:
+        server.terminate()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "rate": args.rate,
+                    "latency": args.latency,
+                    "length": args.length,
+                    "scenarios": report,
+                },
+                f,
+                indent=4,
+                sort_keys=True,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks for all_network_speedtest.py"
+    )
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    distance = sub.add_parser("distance", help="closest server selection")
+    distance.add_argument("--servers", type=int, default=10000)
+    distance.add_argument("--limit", type=int, default=5)
+    distance.add_argument("--repeat", type=int, default=5)
+    distance.add_argument("--seed", type=int, default=1)
+    distance.set_defaults(func=bench_distance)
+
+    loopback = sub.add_parser(
+        "loopback", help="full tests against a local loopback server"
+    )
+    loopback.add_argument(
+        "--rate", type=float, default=0, help="Mbit/s per direction, 0 unlimited"
+    )
+    loopback.add_argument(
+        "--latency", type=float, default=0, help="ms added to every response"
+    )
+    loopback.add_argument("--length", type=int, default=5, help="test length in s")
+    loopback.add_argument("--repeat", type=int, default=3)
+    loopback.add_argument("--port", type=int, default=8089)
+    loopback.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(LOOPBACK_SCENARIOS),
+        help="may be repeated, default all",
+    )
+    loopback.add_argument("--json", help="also write the results to this file")
+    loopback.set_defaults(func=bench_loopback)
+
+    args = parser.parse_args()
+    args.func(load_speedtest(), args)
+
+
+if __name__ == "__main__":
+    main()
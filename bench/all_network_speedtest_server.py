@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# Loopback stand-in for the speedtest.net endpoints used by
+# scripts/all_network_speedtest.py
+#
+# Not an RMM script, run it locally to test or benchmark the speedtest
+# engine without hitting speedtest.net:
+#
+#   python bench/all_network_speedtest_server.py --port 8080 --rate 500 --latency 20
+#
+# Serves speedtest-config.php, speedtest-servers-static.php, latency.txt,
+# random{N}x{N}.jpg and the upload.php sink. --rate shapes the aggregate
+# throughput of each direction, --latency delays every response. Uploads are
+# shaped as the server reads them, so the client can briefly run ahead by
+# the size of the socket buffers
+
+import argparse
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONFIG = """<?xml version="1.0" encoding="UTF-8"?>
+<settings>
+<client ip="127.0.0.1" lat="40.0000" lon="-75.0000" isp="Loopback" isprating="3.7" rating="0" ispdlavg="0" ispulavg="0" loggedin="0" country="US" />
+<server-config threadcount="%(threads)d" ignoreids="" notonmap="" forcepingid="" preferredserverid="" />
+<download testlength="%(length)d" initialtest="250K" mintestsize="250K" threadsperurl="4" />
+<upload testlength="%(length)d" ratio="5" initialtest="0" mintestsize="32K" threads="2" maxchunksize="512K" maxchunkcount="50" threadsperurl="4" />
+</settings>
+"""
+
+SERVER = (
+    '<server url="http://%(host)s/speedtest/upload.php" lat="%(lat).4f" '
+    'lon="%(lon).4f" name="Loopback %(id)d" country="Loopback" cc="LO" '
+    'sponsor="Loopback" id="%(id)d" host="%(host)s" />'
+)
+
+RANDOM = re.compile(r"/random(\d+)x\1\.jpg$")
+CHUNK = 65536
+
+
+class Shaper(object):
+    """Shape the aggregate throughput of every connection in one direction
+    to ``rate`` bytes per second, unlimited when ``0``
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def take(self, n):
+        """Account for ``n`` bytes, sleeping until the link has sent them"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + n / self.rate
+            delay = self._next - now
+        time.sleep(delay)
+
+
+class LoopbackHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_body(self, body, content_type="text/plain"):
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path.endswith("/speedtest-config.php"):
+            return self.send_body(self.server.config, "text/xml")
+        if path.endswith("/speedtest-servers-static.php") or path.endswith(
+            "/speedtest-servers.php"
+        ):
+            return self.send_body(self.server.server_list, "text/xml")
+        if path.endswith("/latency.txt"):
+            return self.send_body(b"test=test")
+        match = RANDOM.search(path)
+        if match:
+            return self.send_random(int(match.group(1)))
+        if path.endswith("/upload.php"):
+            return self.send_body(b"", "text/html")
+        self.send_error(404)
+
+    def send_random(self, n):
+        # About the size of the speedtest.net images of the same name
+        size = n * n * 2
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        chunk = self.server.chunk
+        sent = 0
+        try:
+            while sent < size:
+                n = min(CHUNK, size - sent)
+                self.server.download.take(n)
+                self.wfile.write(chunk[:n])
+                sent += n
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        received = 0
+        try:
+            while received < length:
+                data = self.rfile.read(min(CHUNK, length - received))
+                if not data:
+                    break
+                self.server.upload.take(len(data))
+                received += len(data)
+        except ConnectionResetError:
+            self.close_connection = True
+            return
+        if received < length:
+            # The client cut the upload short at the end of the test
+            self.close_connection = True
+            return
+        self.send_body(b"size=%d" % received)
+
+
+def make_server(
+    host="127.0.0.1", port=0, rate=0, latency=0, servers=10, length=10, threads=4
+):
+    """Build a ``ThreadingHTTPServer`` serving the speedtest.net endpoints
+
+    ``rate`` shapes each direction to that many bytes per second across all
+    connections, ``latency`` is added to every response in seconds, and
+    the configuration advertises ``servers`` test servers, all served by
+    this one, with tests of ``length`` seconds
+    """
+
+    server = ThreadingHTTPServer((host, port), LoopbackHandler)
+    server.daemon_threads = True
+    server.verbose = False
+    server.latency = latency
+    server.download = Shaper(rate)
+    server.upload = Shaper(rate)
+    server.chunk = b"x" * CHUNK
+
+    address = "%s:%d" % server.server_address[:2]
+    rnd = random.Random(1)
+    server.config = (CONFIG % {"threads": threads, "length": length}).encode()
+    server.server_list = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<settings>\n<servers>\n%s\n'
+        "</servers>\n</settings>\n"
+        % "\n".join(
+            SERVER
+            % {
+                "host": address,
+                "id": i,
+                "lat": 40.0 + rnd.uniform(-5, 5),
+                "lon": -75.0 + rnd.uniform(-5, 5),
+            }
+            for i in range(1, servers + 1)
+        )
+    ).encode()
+    server.url = "http://%s" % address
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Loopback stand-in for the speedtest.net endpoints"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--rate", type=float, default=0, help="Mbit/s per direction, 0 unlimited"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="ms added to every response"
+    )
+    parser.add_argument("--servers", type=int, default=10)
+    parser.add_argument("--length", type=int, default=10, help="test length in s")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = make_server(
+        args.host,
+        args.port,
+        rate=args.rate * 1000 * 1000 / 8,
+        latency=args.latency / 1000.0,
+        servers=args.servers,
+        length=args.length,
+    )
+    server.verbose = args.verbose
+    print("Serving speedtest.net endpoints on %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
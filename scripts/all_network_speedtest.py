@@ -15,27 +15,31 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import array
+import collections
 import csv
 import datetime
 import errno
+import heapq
 import math
+import mmap
 import os
 import platform
 import re
 import signal
 import socket
+import stat
+import struct
 import sys
+import tempfile
 import threading
 import timeit
 import xml.parsers.expat
 
 try:
-    import gzip
-
-    GZIP_BASE = gzip.GzipFile
+    import zlib
 except ImportError:
-    gzip = None
-    GZIP_BASE = object
+    zlib = None
 
 __version__ = "2.1.4b1"
 
@@ -55,6 +59,14 @@ class FakeShutdownEvent(object):
 
 # Some global variables we use
 DEBUG = False
+PROCESS_START_TIMEOUT = 60
+# Upper bounds in ms of the latency increase under load for each grade
+BUFFERBLOAT_GRADES = ((5, "A+"), (30, "A"), (60, "B"), (200, "C"), (400, "D"))
+# Binary result history: a header of magic and record size, then records of
+# timestamp, server id, ping, download, upload, bytes received and bytes sent
+HISTORY_MAGIC = "STH1".encode()
+HISTORY_HEADER = "<4sH"
+HISTORY_RECORD = "<dIdddQQ"
 _GLOBAL_DEFAULT_TIMEOUT = object()
 PY25PLUS = sys.version_info[:2] >= (2, 5)
 PY26PLUS = sys.version_info[:2] >= (2, 6)
@@ -70,6 +82,17 @@ except ImportError:
     except ImportError:
         json = None
 
+try:
+    import multiprocessing
+    from multiprocessing.connection import wait as wait_connections
+except ImportError:
+    multiprocessing = None
+
+try:
+    import asyncio
+except (ImportError, SyntaxError):
+    asyncio = None
+
 try:
     import xml.etree.ElementTree as ET
 
@@ -111,9 +134,9 @@ except ImportError:
     )
 
 try:
-    from httplib import HTTPConnection, BadStatusLine
+    from httplib import HTTPConnection, BadStatusLine, HTTPException
 except ImportError:
-    from http.client import HTTPConnection, BadStatusLine
+    from http.client import HTTPConnection, BadStatusLine, HTTPException
 
 try:
     from httplib import HTTPSConnection
@@ -129,9 +152,9 @@ except ImportError:
     FakeSocket = None
 
 try:
-    from Queue import Queue
+    from Queue import Queue, Empty
 except ImportError:
-    from queue import Queue
+    from queue import Queue, Empty
 
 try:
     from urlparse import urlparse
@@ -402,7 +425,125 @@ class SpeedtestMissingBestServer(SpeedtestException):
     """get_best_server not called or not able to determine best server"""
 
 
-def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+class SpeedtestProcessFailure(SpeedtestException):
+    """Worker processes of a multi process test failed to start"""
+
+
+class SpeedtestAddressFamilyError(SpeedtestException):
+    """The best server could not be reached over the requested address
+    family
+    """
+
+
+def server_address(server):
+    """Return the host and port of the URL of ``server``"""
+
+    urlparts = urlparse(server["url"])
+    return urlparts.hostname, urlparts.port or (80, 443)[urlparts.scheme == "https"]
+
+
+def family_name(family):
+    """Return the name of the address family ``family``"""
+
+    if family == socket.AF_INET6:
+        return "IPv6"
+    if family == socket.AF_INET:
+        return "IPv4"
+    return "any"
+
+
+class SpeedtestResolver(object):
+    """Resolve hosts once and pin their addresses for every later
+    connection to them
+
+    ``pin`` resolves a host restricted to the address family of
+    ``source_address``, when given, so a bound source address is never
+    paired with an address of the other family. ``resolve`` returns the
+    pinned addresses, falling back to ``getaddrinfo`` for other hosts
+    """
+
+    def __init__(self, source_address=None):
+        if not source_address:
+            self.family = 0
+        elif ":" in source_address:
+            self.family = socket.AF_INET6
+        else:
+            self.family = socket.AF_INET
+        self.pinned = {}
+
+    def pin(self, host, port):
+        """Resolve and pin ``host`` and ``port``, returning the seconds the
+        lookup took and the addresses it returned
+        """
+        start = timeit.default_timer()
+        addresses = socket.getaddrinfo(host, port, self.family, socket.SOCK_STREAM)
+        elapsed = timeit.default_timer() - start
+        self.pinned[(host, int(port))] = addresses
+        return elapsed, addresses
+
+    def resolve(self, host, port):
+        """Return the ``getaddrinfo`` results for ``host`` and ``port``"""
+        addresses = self.pinned.get((host, int(port)))
+        if addresses is None:
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        return addresses
+
+
+class SpeedtestTLS(object):
+    """TLS state shared by every HTTPS connection of a speedtest
+
+    Connections share one ``SSLContext``, so certificates are loaded
+    once, and resume the TLS session of an earlier connection to the same
+    host and port, where Python supports it. The time each handshake took
+    is recorded in ``handshakes`` as ``(seconds, resumed)`` tuples
+    """
+
+    def __init__(self):
+        if ssl and hasattr(ssl, "create_default_context"):
+            self.context = ssl.create_default_context()
+        else:
+            self.context = None
+        self.resume = bool(ssl) and hasattr(ssl, "SSLSession")
+        self.sessions = {}
+        self.handshakes = []
+
+    def __getstate__(self):
+        # Neither SSLContext nor SSLSession can be pickled, a worker process
+        # starts afresh
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def wrap(self, sock, key, **kwargs):
+        """Wrap ``sock`` with the shared context, resuming the session saved
+        for ``key``, a ``(host, port)`` tuple, if any
+        """
+        session = self.resume and self.sessions.get(key) or None
+        if session is not None:
+            kwargs["session"] = session
+        start = timeit.default_timer()
+        sock = self.context.wrap_socket(sock, **kwargs)
+        self.handshakes.append(
+            (timeit.default_timer() - start, bool(getattr(sock, "session_reused", 0)))
+        )
+        self.save(sock, key)
+        return sock
+
+    def save(self, sock, key):
+        """Save the session of ``sock`` for resumption by later connections
+        to ``key``
+        """
+        # TLS 1.3 sessions only become resumable once the server's session
+        # ticket has been read, so this is also called after each response
+        session = self.resume and getattr(sock, "session", None) or None
+        if session is not None:
+            self.sessions[key] = session
+
+
+def create_connection(
+    address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=None, resolver=None
+):
     """Connect to *address* and return the socket object.
 
     Convenience function.  Connect to *address* (a 2-tuple ``(host,
@@ -412,14 +553,19 @@ def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=N
     global default timeout setting returned by :func:`getdefaulttimeout`
     is used.  If *source_address* is set it must be a tuple of (host, port)
     for the socket to bind as a source address before making the connection.
-    An host of '' or port 0 tells the OS to use the default.
+    An host of '' or port 0 tells the OS to use the default. A
+    ``SpeedtestResolver`` given as *resolver* supplies the addresses.
 
     Largely vendored from Python 2.7, modified to work with Python 2.4
     """
 
     host, port = address
     err = None
-    for res in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+    if resolver is not None:
+        addresses = resolver.resolve(host, port)
+    else:
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    for res in addresses:
         af, socktype, proto, canonname, sa = res
         sock = None
         try:
@@ -444,12 +590,13 @@ def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=N
 
 class SpeedtestHTTPConnection(HTTPConnection):
     """Custom HTTPConnection to support source_address across
-    Python 2.4 - Python 3
+    Python 2.4 - Python 3, and addresses pinned by a ``SpeedtestResolver``
     """
 
     def __init__(self, *args, **kwargs):
         source_address = kwargs.pop("source_address", None)
         timeout = kwargs.pop("timeout", 10)
+        resolver = kwargs.pop("resolver", None)
 
         self._tunnel_host = None
 
@@ -457,17 +604,23 @@ class SpeedtestHTTPConnection(HTTPConnection):
 
         self.source_address = source_address
         self.timeout = timeout
+        self.resolver = resolver
 
     def connect(self):
         """Connect to the host and port specified in __init__."""
-        try:
-            self.sock = socket.create_connection(
-                (self.host, self.port), self.timeout, self.source_address
-            )
-        except (AttributeError, TypeError):
+        if self.resolver is not None:
             self.sock = create_connection(
-                (self.host, self.port), self.timeout, self.source_address
+                (self.host, self.port), self.timeout, self.source_address, self.resolver
             )
+        else:
+            try:
+                self.sock = socket.create_connection(
+                    (self.host, self.port), self.timeout, self.source_address
+                )
+            except (AttributeError, TypeError):
+                self.sock = create_connection(
+                    (self.host, self.port), self.timeout, self.source_address
+                )
 
         if self._tunnel_host:
             self._tunnel()
@@ -477,7 +630,8 @@ if HTTPSConnection:
 
     class SpeedtestHTTPSConnection(HTTPSConnection):
         """Custom HTTPSConnection to support source_address across
-        Python 2.4 - Python 3
+        Python 2.4 - Python 3, and addresses pinned by a
+        ``SpeedtestResolver``
         """
 
         default_port = 443
@@ -485,6 +639,10 @@ if HTTPSConnection:
         def __init__(self, *args, **kwargs):
             source_address = kwargs.pop("source_address", None)
             timeout = kwargs.pop("timeout", 10)
+            resolver = kwargs.pop("resolver", None)
+            tls = kwargs.pop("tls", None)
+            if tls is not None and tls.context is not None:
+                kwargs.setdefault("context", tls.context)
 
             self._tunnel_host = None
 
@@ -492,17 +650,27 @@ if HTTPSConnection:
 
             self.timeout = timeout
             self.source_address = source_address
+            self.resolver = resolver
+            self.tls = tls
 
         def connect(self):
             "Connect to a host on a given (SSL) port."
-            try:
-                self.sock = socket.create_connection(
-                    (self.host, self.port), self.timeout, self.source_address
-                )
-            except (AttributeError, TypeError):
+            if self.resolver is not None:
                 self.sock = create_connection(
-                    (self.host, self.port), self.timeout, self.source_address
+                    (self.host, self.port),
+                    self.timeout,
+                    self.source_address,
+                    self.resolver,
                 )
+            else:
+                try:
+                    self.sock = socket.create_connection(
+                        (self.host, self.port), self.timeout, self.source_address
+                    )
+                except (AttributeError, TypeError):
+                    self.sock = create_connection(
+                        (self.host, self.port), self.timeout, self.source_address
+                    )
 
             if self._tunnel_host:
                 self._tunnel()
@@ -515,7 +683,20 @@ if HTTPSConnection:
                             kwargs["server_hostname"] = self._tunnel_host
                         else:
                             kwargs["server_hostname"] = self.host
-                    self.sock = self._context.wrap_socket(self.sock, **kwargs)
+                    if self.tls is not None and self._context is self.tls.context:
+                        try:
+                            # The client sends the last flight of a resumed
+                            # handshake, the request written after it would
+                            # otherwise stall on Nagle's algorithm waiting
+                            # for a delayed ACK
+                            self.sock.setsockopt(
+                                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+                            )
+                        except (AttributeError, socket.error):
+                            pass
+                        self.sock = self.tls.wrap(self.sock, self._tls_key(), **kwargs)
+                    else:
+                        self.sock = self._context.wrap_socket(self.sock, **kwargs)
                 except AttributeError:
                     self.sock = ssl.wrap_socket(self.sock)
                     try:
@@ -536,8 +717,24 @@ if HTTPSConnection:
                     "This version of Python does not support HTTPS/SSL " "functionality"
                 )
 
+        def _tls_key(self):
+            return (self._tunnel_host or self.host, self.port)
+
+        def getresponse(self, *args, **kwargs):
+            response = HTTPSConnection.getresponse(self, *args, **kwargs)
+            if self.tls is not None and self.sock is not None:
+                self.tls.save(self.sock, self._tls_key())
+            return response
 
-def _build_connection(connection, source_address, timeout, context=None):
+        def close(self):
+            if self.tls is not None and self.sock is not None:
+                self.tls.save(self.sock, self._tls_key())
+            HTTPSConnection.close(self)
+
+
+def _build_connection(
+    connection, source_address, timeout, context=None, resolver=None, tls=None
+):
     """Cross Python 2.4 - Python 3 callable to build an ``HTTPConnection`` or
     ``HTTPSConnection`` with the args we need
 
@@ -546,9 +743,17 @@ def _build_connection(connection, source_address, timeout, context=None):
     """
 
     def inner(host, **kwargs):
-        kwargs.update({"source_address": source_address, "timeout": timeout})
+        kwargs.update(
+            {
+                "source_address": source_address,
+                "timeout": timeout,
+                "resolver": resolver,
+            }
+        )
         if context:
             kwargs["context"] = context
+        if tls is not None:
+            kwargs["tls"] = tls
         return connection(host, **kwargs)
 
     return inner
@@ -556,18 +761,22 @@ def _build_connection(connection, source_address, timeout, context=None):
 
 class SpeedtestHTTPHandler(AbstractHTTPHandler):
     """Custom ``HTTPHandler`` that can build a ``HTTPConnection`` with the
-    args we need for ``source_address`` and ``timeout``
+    args we need for ``source_address``, ``timeout`` and ``resolver``
     """
 
-    def __init__(self, debuglevel=0, source_address=None, timeout=10):
+    def __init__(self, debuglevel=0, source_address=None, timeout=10, resolver=None):
         AbstractHTTPHandler.__init__(self, debuglevel)
         self.source_address = source_address
         self.timeout = timeout
+        self.resolver = resolver
 
     def http_open(self, req):
         return self.do_open(
             _build_connection(
-                SpeedtestHTTPConnection, self.source_address, self.timeout
+                SpeedtestHTTPConnection,
+                self.source_address,
+                self.timeout,
+                resolver=self.resolver,
             ),
             req,
         )
@@ -577,14 +786,25 @@ class SpeedtestHTTPHandler(AbstractHTTPHandler):
 
 class SpeedtestHTTPSHandler(AbstractHTTPHandler):
     """Custom ``HTTPSHandler`` that can build a ``HTTPSConnection`` with the
-    args we need for ``source_address`` and ``timeout``
+    args we need for ``source_address``, ``timeout``, ``resolver`` and
+    ``tls``
     """
 
-    def __init__(self, debuglevel=0, context=None, source_address=None, timeout=10):
+    def __init__(
+        self,
+        debuglevel=0,
+        context=None,
+        source_address=None,
+        timeout=10,
+        resolver=None,
+        tls=None,
+    ):
         AbstractHTTPHandler.__init__(self, debuglevel)
         self._context = context
         self.source_address = source_address
         self.timeout = timeout
+        self.resolver = resolver
+        self.tls = tls
 
     def https_open(self, req):
         return self.do_open(
@@ -593,6 +813,8 @@ class SpeedtestHTTPSHandler(AbstractHTTPHandler):
                 self.source_address,
                 self.timeout,
                 context=self._context,
+                resolver=self.resolver,
+                tls=self.tls,
             ),
             req,
         )
@@ -600,10 +822,11 @@ class SpeedtestHTTPSHandler(AbstractHTTPHandler):
     https_request = AbstractHTTPHandler.do_request_
 
 
-def build_opener(source_address=None, timeout=10):
+def build_opener(source_address=None, timeout=10, resolver=None, tls=None):
     """Function similar to ``urllib2.build_opener`` that will build
     an ``OpenerDirector`` with the explicit handlers we want,
-    ``source_address`` for binding, ``timeout`` and our custom
+    ``source_address`` for binding, ``timeout``, a ``SpeedtestResolver``,
+    the ``SpeedtestTLS`` shared by HTTPS connections and our custom
     `User-Agent`
     """
 
@@ -617,8 +840,15 @@ def build_opener(source_address=None, timeout=10):
 
     handlers = [
         ProxyHandler(),
-        SpeedtestHTTPHandler(source_address=source_address_tuple, timeout=timeout),
-        SpeedtestHTTPSHandler(source_address=source_address_tuple, timeout=timeout),
+        SpeedtestHTTPHandler(
+            source_address=source_address_tuple, timeout=timeout, resolver=resolver
+        ),
+        SpeedtestHTTPSHandler(
+            source_address=source_address_tuple,
+            timeout=timeout,
+            resolver=resolver,
+            tls=tls,
+        ),
         HTTPDefaultErrorHandler(),
         HTTPRedirectHandler(),
         HTTPErrorProcessor(),
@@ -633,37 +863,177 @@ def build_opener(source_address=None, timeout=10):
     return opener
 
 
-class GzipDecodedResponse(GZIP_BASE):
+class SpeedtestPersistentOpener(object):
+    """Opener similar to ``OpenerDirector`` that sends every request over
+    a single kept alive ``SpeedtestHTTPConnection`` or
+    ``SpeedtestHTTPSConnection``, instead of establishing a new connection
+    per request
+
+    Requests are made directly to the server, bypassing any proxy, and
+    redirects are not followed. Connections use the addresses pinned by
+    ``resolver``, and HTTPS connections the ``SpeedtestTLS`` ``tls``, when
+    given
+    """
+
+    def __init__(self, source_address=None, timeout=10, resolver=None, tls=None):
+        if source_address:
+            self.source_address = (source_address, 0)
+        else:
+            self.source_address = None
+        self.timeout = timeout
+        self.resolver = resolver
+        self.tls = tls
+        self.user_agent = build_user_agent()
+
+        self._connection = None
+        self._origin = None
+        self._response = None
+
+    def _connect(self, scheme, netloc):
+        kwargs = {}
+        if scheme == "https":
+            connection = SpeedtestHTTPSConnection
+            kwargs["tls"] = self.tls
+        else:
+            connection = SpeedtestHTTPConnection
+        self._connection = connection(
+            netloc,
+            source_address=self.source_address,
+            timeout=self.timeout,
+            resolver=self.resolver,
+            **kwargs
+        )
+        self._origin = (scheme, netloc)
+        self._connection.connect()
+        try:
+            # Requests on a reused connection would otherwise stall on
+            # Nagle's algorithm waiting for a delayed ACK
+            self._connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, socket.error):
+            pass
+        printer("Opened persistent connection to %s://%s" % self._origin, debug=True)
+
+    def _release(self):
+        """Make the connection reusable after the previous response, or
+        close it if the response body was not fully consumed
+        """
+        response = self._response
+        self._response = None
+        if response is None:
+            return
+        if not response.isclosed() or response.length != 0 or response.will_close:
+            self.close()
+
+    def open(self, request):
+        """Send ``request`` and return the response, reconnecting once if
+        an idle kept alive connection was closed by the server
+        """
+        self._release()
+
+        urlparts = urlparse(request.get_full_url())
+        if self._origin != (urlparts[0], urlparts[1]):
+            self.close()
+        reused = self._connection is not None
+        if not reused:
+            self._connect(urlparts[0], urlparts[1])
+
+        path = urlparts[2] or "/"
+        if urlparts[4]:
+            path = "%s?%s" % (path, urlparts[4])
+        headers = dict(request.header_items())
+        headers["User-Agent"] = self.user_agent
+
+        try:
+            self._connection.request(request.get_method(), path, request.data, headers)
+            response = self._connection.getresponse()
+        except HTTP_ERRORS:
+            e = get_exception()
+            self.close()
+            if not reused or request.data is not None or isinstance(e, socket.timeout):
+                raise
+            self._connect(urlparts[0], urlparts[1])
+            self._connection.request(request.get_method(), path, request.data, headers)
+            response = self._connection.getresponse()
+        except Exception:
+            self.close()
+            raise
+
+        self._response = response
+        if int(response.status) >= 400:
+            raise HTTPError(
+                request.get_full_url(),
+                response.status,
+                response.reason,
+                response.msg,
+                response,
+            )
+        return response
+
+    def close(self):
+        self._response = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class GzipDecodedResponse(object):
     """A file-like object to decode a response encoded with the gzip
-    method, as described in RFC 1952.
+    method, as described in RFC 1952, as it is read
 
-    Largely copied from ``xmlrpclib``/``xmlrpc.client`` and modified
-    to work for py2.4-py3
+    The response is read ``chunk_size`` compressed bytes at a time, only
+    as needed to return the decoded bytes asked for, so the body is never
+    held in full, compressed or decoded
     """
 
-    def __init__(self, response):
-        # response doesn't support tell() and read(), required by
-        # GzipFile
-        if not gzip:
+    def __init__(self, response, chunk_size=16384):
+        if not zlib:
             raise SpeedtestHTTPError(
                 "HTTP response body is gzip encoded, "
                 "but gzip support is not available"
             )
-        IO = BytesIO or StringIO
-        self.io = IO()
-        while 1:
-            chunk = response.read(1024)
-            if len(chunk) == 0:
-                break
-            self.io.write(chunk)
-        self.io.seek(0)
-        gzip.GzipFile.__init__(self, mode="rb", fileobj=self.io)
+        self.response = response
+        self.chunk_size = chunk_size
+        self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = "".encode()
+        self._done = False
+
+    def _decode(self):
+        """Read and decode the next chunk of the response"""
+        data = self.response.read(self.chunk_size)
+        try:
+            if not data:
+                self._done = True
+                self._buffer += self._decoder.flush()
+                # ``eof`` is only available from Python 3.3
+                if not getattr(self._decoder, "eof", True):
+                    raise EOFError(
+                        "Compressed response ended before the end-of-stream "
+                        "marker was reached"
+                    )
+                return
+            decoded = self._decoder.decompress(data)
+            # Another gzip member may follow the end of this one
+            while self._decoder.unused_data:
+                data = self._decoder.unused_data
+                self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                decoded += self._decoder.decompress(data)
+        except zlib.error:
+            raise IOError("Invalid gzip encoded response: %s" % get_exception())
+        self._buffer += decoded
+
+    def read(self, size=-1):
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            self._decode()
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
 
     def close(self):
-        try:
-            gzip.GzipFile.close(self)
-        finally:
-            self.io.close()
+        self._buffer = "".encode()
+        self._decoder = None
+        self._done = True
 
 
 def get_exception():
@@ -691,6 +1061,238 @@ def distance(origin, destination):
     return d
 
 
+def percentile(values, pct):
+    """Return the ``pct`` percentile of ``values``, linearly interpolating
+    between the closest ranks. Returns ``None`` for no values
+    """
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * (pct / 100.0)
+    f = int(math.floor(k))
+    c = min(f + 1, len(ordered) - 1)
+    return ordered[f] + (ordered[c] - ordered[f]) * (k - f)
+
+
+def score_latencies(samples, count=3):
+    """Score ``count`` latency probes, where failed probes are ``None``,
+    returning the speedtest.net "ping" in ms and the successful samples
+
+    Failed probes are penalized with 3600 seconds each
+    """
+
+    latencies = [sample for sample in samples if sample is not None]
+    cum = latencies + [3600] * (count - len(latencies))
+    return round((sum(cum) / (count * 2.0)) * 1000.0, 3), latencies
+
+
+def latency_stats(samples):
+    """Summarize latency samples in seconds as min/median/jitter in ms
+
+    Jitter is the mean absolute difference between consecutive samples
+    """
+
+    if not samples:
+        return {}
+    if len(samples) > 1:
+        jitter = sum(
+            abs(samples[i] - samples[i - 1]) for i in range(1, len(samples))
+        ) / (len(samples) - 1)
+    else:
+        jitter = 0
+    return {
+        "min": round(min(samples) * 1000.0, 3),
+        "median": round(percentile(samples, 50) * 1000.0, 3),
+        "jitter": round(jitter * 1000.0, 3),
+        "samples": len(samples),
+    }
+
+
+def handshake_stats(handshakes):
+    """Summarize ``(seconds, resumed)`` TLS handshakes as their count and
+    mean duration in ms, overall and of full and resumed handshakes
+    """
+
+    if not handshakes:
+        return {}
+
+    def mean(samples):
+        if not samples:
+            return None
+        return round(sum(samples) / len(samples) * 1000.0, 3)
+
+    full = [seconds for seconds, resumed in handshakes if not resumed]
+    resumed = [seconds for seconds, resumed in handshakes if resumed]
+    return {
+        "handshakes": len(handshakes),
+        "resumed": len(resumed),
+        "mean": mean(full + resumed),
+        "mean_full": mean(full),
+        "mean_resumed": mean(resumed),
+    }
+
+
+def latency_percentiles(samples):
+    """Summarize latency samples in seconds as min/p50/p90/max in ms"""
+
+    if not samples:
+        return {}
+    return {
+        "min": round(min(samples) * 1000.0, 3),
+        "p50": round(percentile(samples, 50) * 1000.0, 3),
+        "p90": round(percentile(samples, 90) * 1000.0, 3),
+        "max": round(max(samples) * 1000.0, 3),
+        "samples": len(samples),
+    }
+
+
+def bufferbloat_grade(increase):
+    """Grade an ``increase`` in latency under load, in ms, from A+ to F"""
+
+    for limit, grade in BUFFERBLOAT_GRADES:
+        if increase < limit:
+            return grade
+    return "F"
+
+
+def throughput_stats(samples, interval, threshold=0.5, window=1.0):
+    """Summarize ``samples``, running totals of bytes transferred taken
+    every ``interval`` seconds, as throughput in bits per second
+
+    Throughput is smoothed over a centred ``window`` of seconds. The warm
+    up before it first reaches ``threshold`` of its 90th percentile, and
+    the tail after it last does, are trimmed. ``steady`` is the throughput
+    over the remaining samples, and the percentiles are of the smoothed
+    throughput over them
+    """
+
+    if not samples:
+        return {}
+    totals = [0.0]
+    totals.extend(samples)
+    count = len(samples)
+    half = max(0, int(round(window / interval)) // 2)
+
+    rates = []
+    for k in range(count):
+        lo = max(0, k - half)
+        hi = min(count, k + half + 1)
+        rates.append((totals[hi] - totals[lo]) / ((hi - lo) * interval) * 8.0)
+
+    level = percentile(rates, 90) * threshold
+    above = [k for k in range(count) if rates[k] >= level]
+    first, last = above[0], above[-1] + 1
+    steady = rates[first:last]
+    return {
+        "steady": (totals[last] - totals[first]) / ((last - first) * interval) * 8.0,
+        "p10": percentile(steady, 10),
+        "p50": percentile(steady, 50),
+        "p90": percentile(steady, 90),
+        "warmup": round(first * interval, 3),
+        "tail": round((count - last) * interval, 3),
+        "interval": interval,
+        "samples": [int(totals[k + 1] - totals[k]) for k in range(count)],
+    }
+
+
+class ServerIndex(object):
+    """Compact, array backed index of speedtest.net servers
+
+    Server coordinates are held in parallel arrays, so that distances from
+    an origin can be computed in a single batched pass, and are cached
+    for that origin. Selecting the closest servers is a partial selection
+    over the cached distances rather than a sort of the full list
+    """
+
+    def __init__(self):
+        self.ids = array.array("l")
+        self.lats = array.array("d")
+        self.lons = array.array("d")
+        self.servers = []
+
+        self._origin = None
+        self._distances = None
+
+    def __len__(self):
+        return len(self.servers)
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def __nonzero__(self):
+        return bool(self.servers)
+
+    __bool__ = __nonzero__
+
+    def add(self, server_id, lat, lon, attrib):
+        """Add a server, with ``attrib`` holding all of its attributes"""
+        self.ids.append(server_id)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.servers.append(attrib)
+        self._distances = None
+
+    def clear(self):
+        for values in (self.ids, self.lats, self.lons, self.servers):
+            del values[:]
+        self._distances = None
+
+    def distances(self, origin):
+        """Return an array of the distances in km between ``origin`` and
+        every server, using the haversine formula
+        """
+
+        if self._distances is not None and self._origin == origin:
+            return self._distances
+
+        rad = math.pi / 180
+        lat1, lon1 = origin[0] * rad, origin[1] * rad
+        cos_lat1 = math.cos(lat1)
+        sin = math.sin
+        cos = math.cos
+        asin = math.asin
+        sqrt = math.sqrt
+        diameter = 2 * 6371  # km
+
+        distances = array.array("d")
+        append = distances.append
+        for lat2, lon2 in zip(self.lats, self.lons):
+            lat2 *= rad
+            dlat = sin((lat2 - lat1) * 0.5)
+            dlon = sin((lon2 * rad - lon1) * 0.5)
+            a = dlat * dlat + cos_lat1 * cos(lat2) * dlon * dlon
+            append(diameter * asin(sqrt(a if a < 1.0 else 1.0)))
+
+        self._origin = origin
+        self._distances = distances
+        return distances
+
+    def _servers(self, distances, indices):
+        servers = []
+        for i in indices:
+            attrib = self.servers[i]
+            attrib["d"] = distances[i]
+            servers.append(attrib)
+        return servers
+
+    def closest(self, origin, limit):
+        """Return the ``limit`` servers closest to ``origin``, closest
+        first, without sorting every server
+        """
+        distances = self.distances(origin)
+        indices = heapq.nsmallest(
+            limit, range(len(distances)), key=distances.__getitem__
+        )
+        return self._servers(distances, indices)
+
+    def by_distance(self, origin):
+        """Return every server sorted by distance from ``origin``"""
+        distances = self.distances(origin)
+        indices = sorted(range(len(distances)), key=distances.__getitem__)
+        return self._servers(distances, indices)
+
+
 def build_user_agent():
     """Build a Mozilla/5.0 compatible User-Agent string"""
 
@@ -773,15 +1375,23 @@ def get_response_stream(response):
 
     """
 
+    if get_response_header(response, "content-encoding") == "gzip":
+        return GzipDecodedResponse(response)
+
+    return response
+
+
+def get_response_header(response, name):
+    """Helper function to return the value of the ``name`` header of a
+    response across py2.4-py3, or ``None`` when it is not set
+    """
+
     try:
         getheader = response.headers.getheader
     except AttributeError:
         getheader = response.getheader
 
-    if getheader("content-encoding") == "gzip":
-        return GzipDecodedResponse(response)
-
-    return response
+    return getheader(name)
 
 
 def get_attributes_by_tag_name(dom, tag_name):
@@ -795,6 +1405,38 @@ def get_attributes_by_tag_name(dom, tag_name):
     return dict(list(elem.attributes.items()))
 
 
+def iter_server_attributes(stream, chunk_size=65536):
+    """Incrementally parse a speedtest.net server list read from ``stream``
+    in ``chunk_size`` pieces, yielding the attributes of every ``server``
+    element as soon as it has been parsed
+    """
+
+    parsed = []
+
+    def start_element(name, attrs):
+        if name == "server":
+            parsed.append(attrs)
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+
+    while 1:
+        try:
+            chunk = stream.read(chunk_size)
+        except (OSError, EOFError):
+            raise ServersRetrievalError(get_exception())
+        try:
+            parser.Parse(chunk, not chunk)
+        except xml.parsers.expat.ExpatError:
+            e = get_exception()
+            raise SpeedtestServersError("Malformed speedtest.net server list: %s" % e)
+        for attrib in parsed:
+            yield attrib
+        del parsed[:]
+        if not chunk:
+            break
+
+
 def print_dots(shutdown_event):
     """Built in callback function used by Thread classes for printing
     status
@@ -816,112 +1458,462 @@ def do_nothing(*args, **kwargs):
     pass
 
 
-class HTTPDownloader(threading.Thread):
-    """Thread class for retrieving a URL"""
+class ThroughputSampler(threading.Thread):
+    """Thread class recording the running total of bytes transferred,
+    as returned by ``counter``, every ``interval`` seconds into
+    ``samples`` until stopped
 
-    def __init__(self, i, request, start, timeout, opener=None, shutdown_event=None):
-        threading.Thread.__init__(self)
-        self.request = request
-        self.result = [0]
-        self.starttime = start
-        self.timeout = timeout
-        self.i = i
-        if opener:
-            self._opener = opener.open
-        else:
-            self._opener = urlopen
+    Each of ``listeners`` is called with ``samples`` after every sample
+    """
 
-        if shutdown_event:
-            self._shutdown_event = shutdown_event
-        else:
-            self._shutdown_event = FakeShutdownEvent()
+    def __init__(self, interval=0.1, counter=None, listeners=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.counter = counter
+        self.listeners = listeners or []
+        self.samples = array.array("d")
+        self._done = threading.Event()
 
     def run(self):
-        try:
-            if (timeit.default_timer() - self.starttime) <= self.timeout:
-                f = self._opener(self.request)
-                while (
-                    not event_is_set(self._shutdown_event)
-                    and (timeit.default_timer() - self.starttime) <= self.timeout
-                ):
-                    self.result.append(len(f.read(10240)))
-                    if self.result[-1] == 0:
-                        break
-                f.close()
-        except IOError:
-            pass
-        except HTTP_ERRORS:
-            pass
+        start = timeit.default_timer()
+        while not event_is_set(self._done):
+            now = timeit.default_timer()
+            delay = start + self.interval * (len(self.samples) + 1) - now
+            if delay > 0:
+                self._done.wait(delay)
+                if event_is_set(self._done):
+                    break
+            self.samples.append(self.counter())
+            for listener in self.listeners:
+                listener(self.samples)
 
+    def stop(self):
+        """Stop sampling, discarding the partial interval in progress"""
+        self._done.set()
+        while thread_is_alive(self):
+            self.join(0.1)
 
-class HTTPUploaderData(object):
-    """File like object to improve cutting off the upload once the timeout
-    has been reached
+
+class AdaptiveDuration(object):
+    """Listener deciding when an adaptive download or upload test ends,
+    from running totals of bytes sampled every ``interval`` seconds
+
+    The test ends once the throughput of each of the last ``checks``
+    windows of ``window`` seconds is within ``tolerance`` of their mean.
+    Otherwise it ends after ``length`` seconds, unless throughput is still
+    climbing, and after ``max_length`` seconds at the latest
+
+    ``stop_event`` is set once the test should end, or once
+    ``shutdown_event`` is set, with the cause in ``reason``
     """
 
-    def __init__(self, length, start, timeout, shutdown_event=None):
+    def __init__(
+        self,
+        interval,
+        length,
+        max_length,
+        tolerance=0.05,
+        window=1.0,
+        checks=3,
+        stop_event=None,
+        shutdown_event=None,
+    ):
+        self.interval = interval
         self.length = length
-        self.start = start
-        self.timeout = timeout
+        self.max_length = max(length, max_length)
+        self.tolerance = tolerance
+        self.window = max(1, int(round(window / interval)))
+        self.checks = checks
+        self.stop_event = stop_event or threading.Event()
+        self.reason = None
+        self.elapsed = 0
 
         if shutdown_event:
             self._shutdown_event = shutdown_event
         else:
             self._shutdown_event = FakeShutdownEvent()
 
-        self._data = None
+    def __call__(self, samples):
+        if self.reason:
+            return
+        count = len(samples)
+        self.elapsed = count * self.interval
+
+        rates = []
+        for j in range(min(self.checks, count // self.window)):
+            hi = count - j * self.window
+            lo = hi - self.window
+            rates.append(samples[hi - 1] - (lo and samples[lo - 1]))
+
+        if event_is_set(self._shutdown_event):
+            self.stop("shutdown")
+        elif len(rates) == self.checks and self.stable(rates):
+            self.stop("stable")
+        elif self.elapsed >= self.max_length:
+            self.stop("max_length")
+        elif self.elapsed >= self.length and not (
+            len(rates) > 1 and rates[0] > rates[1] * (1 + self.tolerance)
+        ):
+            self.stop("length")
 
-        self.total = [0]
+    def stable(self, rates):
+        """Whether all of ``rates`` are within ``tolerance`` of their mean"""
+        mean = sum(rates) / float(len(rates))
+        return mean > 0 and max(abs(r - mean) for r in rates) <= (mean * self.tolerance)
 
-    def pre_allocate(self):
-        chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        multiplier = int(round(int(self.length) / 36.0))
-        IO = BytesIO or StringIO
-        try:
-            self._data = IO(
-                (
-                    "content1=%s" % (chars * multiplier)[0 : int(self.length) - 9]
-                ).encode()
-            )
-        except MemoryError:
-            raise SpeedtestCLIError(
-                "Insufficient memory to pre-allocate upload data. Please "
-                "use --no-pre-allocate"
-            )
+    def stop(self, reason):
+        self.reason = reason
+        self.stop_event.set()
 
-    @property
-    def data(self):
-        if not self._data:
-            self.pre_allocate()
-        return self._data
 
-    def read(self, n=10240):
-        if (timeit.default_timer() - self.start) <= self.timeout and not event_is_set(
-            self._shutdown_event
-        ):
-            chunk = self.data.read(n)
-            self.total.append(len(chunk))
-            return chunk
-        else:
-            raise SpeedtestUploadTimeout()
+class ConcurrencyRamp(object):
+    """Listener growing the number of streams of a download or upload
+    test while aggregate throughput keeps rising, from running totals of
+    bytes sampled every ``interval`` seconds
 
-    def __len__(self):
-        return self.length
+    The test starts with ``initial`` streams. After every ``step`` seconds
+    the throughput over the second half of the step is compared with that
+    of the step before. While it rises by more than ``gain``, the streams
+    are doubled by calling ``grow`` with the number to add, up to
+    ``maximum``. Once it stops rising, the streams are held at the knee
 
+    ``steps`` records the ``(streams, bits per second)`` of every step
+    """
 
-class HTTPUploader(threading.Thread):
-    """Thread class for putting a URL"""
+    def __init__(self, interval, initial=1, maximum=32, step=1.0, gain=0.1):
+        self.interval = interval
+        self.streams = initial
+        self.maximum = max(initial, maximum)
+        self.step = max(2, int(round(step / interval)))
+        self.gain = gain
+        self.grow = None
+        self.held = False
+        self.steps = []
+
+    def __call__(self, samples):
+        count = len(samples)
+        if self.held or count % self.step:
+            return
+        half = self.step // 2
+        rate = (samples[-1] - samples[-1 - half]) / (half * self.interval) * 8.0
+        self.steps.append((self.streams, rate))
+
+        if (
+            len(self.steps) > 1 and rate <= self.steps[-2][1] * (1 + self.gain)
+        ) or self.streams >= self.maximum:
+            self.held = True
+            return
+        add = min(self.streams, self.maximum - self.streams)
+        self.streams += add
+        self.grow(add)
 
-    def __init__(
-        self, i, request, start, size, timeout, opener=None, shutdown_event=None
-    ):
+
+class TokenBucket(object):
+    """Byte budget and token bucket rate limit shared by the worker
+    threads of a download or upload test
+
+    At most ``max_bytes`` bytes are granted, and no more than ``max_rate``
+    bytes per second on average, in bursts of up to ``burst`` bytes.
+    Either limit may be ``None``
+    """
+
+    def __init__(self, max_bytes=None, max_rate=None, burst=None):
+        self.max_bytes = max_bytes
+        self.max_rate = max_rate
+        self.remaining = max_bytes
+        self.exhausted = False
+        self.throttled = 0
+
+        if max_rate:
+            self.capacity = burst or max(65536, max_rate / 10.0)
+        else:
+            self.capacity = None
+        self._tokens = self.capacity
+        self._stamp = timeit.default_timer()
+        self._lock = threading.Lock()
+
+    def take(self, n):
+        """Take up to ``n`` bytes from the bucket, sleeping as needed to
+        hold the rate limit, and return the number of bytes granted
+
+        Once the budget is exhausted ``0`` is granted
+        """
+
+        self._lock.acquire()
+        try:
+            if self.remaining is not None:
+                n = min(n, self.remaining)
+                self.remaining -= n
+                if not self.remaining:
+                    self.exhausted = True
+            delay = 0
+            if self.max_rate and n:
+                now = timeit.default_timer()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._stamp) * self.max_rate
+                )
+                self._stamp = now
+                # Tokens go into debt, later takes wait for it to be repaid
+                self._tokens -= n
+                if self._tokens < 0:
+                    delay = -self._tokens / self.max_rate
+                    self.throttled += delay
+        finally:
+            self._lock.release()
+
+        if delay:
+            timeit.time.sleep(delay)
+        return n
+
+    def dict(self):
+        """Return the limits, whether the budget was exhausted, and the
+        total seconds workers waited on the rate limit
+        """
+        if self.max_rate:
+            max_rate = self.max_rate * 8.0
+        else:
+            max_rate = None
+        return {
+            "max_bytes": self.max_bytes,
+            "max_rate": max_rate,
+            "exhausted": self.exhausted,
+            "throttled": round(self.throttled, 3),
+        }
+
+
+class HTTPDownloader(threading.Thread):
+    """Thread class for retrieving URLs
+
+    A downloader is a long lived worker that services ``(i, request)``
+    tuples from the ``requests`` queue until it receives a ``None``
+    sentinel, placing an ``(i, bytes_received)`` tuple on ``results``
+    for every request it services
+
+    Response bodies are received into a single reused buffer of
+    ``buffer_size`` bytes, and ``result`` holds a running count of the
+    bytes received by this thread. Bytes received are taken from the
+    ``TokenBucket`` ``bucket``, when given. ``first_byte`` is the time the
+    first response arrived
+    """
+
+    def __init__(
+        self,
+        i,
+        requests,
+        results,
+        start,
+        timeout,
+        opener=None,
+        shutdown_event=None,
+        callback=do_nothing,
+        request_count=0,
+        buffer_size=65536,
+        bucket=None,
+    ):
         threading.Thread.__init__(self)
-        self.request = request
-        self.request.data.start = self.starttime = start
-        self.size = size
+        self.requests = requests
+        self.results = results
+        self.result = 0
+        self.first_byte = None
+        self.buffer_size = buffer_size
+        self.bucket = bucket
+        self.starttime = start
+        self.timeout = timeout
+        self.i = i
+        self._callback = callback
+        self._request_count = request_count
+        if opener:
+            self._opener = opener.open
+        else:
+            self._opener = urlopen
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def run(self):
+        try:
+            self._buffer = bytearray(self.buffer_size)
+        except NameError:
+            # PY25 and older do not provide bytearray, fall back to read()
+            self._buffer = None
+
+        while 1:
+            item = self.requests.get(True)
+            if item is None:
+                break
+            i, request = item
+            received = 0
+            try:
+                self._callback(i, self._request_count, start=True)
+                received = self.fetch(request)
+            except Exception:
+                # Any failed request must leave the worker alive, or the
+                # requests queued behind it would never be serviced
+                printer("ERROR: %r" % get_exception(), debug=True)
+            finally:
+                self.results.put((i, received), True)
+
+    def transferred(self):
+        """Return the number of bytes received so far by this thread"""
+        return self.result
+
+    def fetch(self, request):
+        """Retrieve a single URL, returning the number of bytes received"""
+        received = 0
+        bucket = self.bucket
+        try:
+            if (
+                (timeit.default_timer() - self.starttime) <= self.timeout
+                and not event_is_set(self._shutdown_event)
+                and not (bucket and bucket.exhausted)
+            ):
+                f = self._opener(request)
+                if self.first_byte is None:
+                    self.first_byte = timeit.default_timer()
+                buf = self._buffer
+                readinto = getattr(f, "readinto", None)
+                if buf is None or readinto is None:
+                    size = self.buffer_size
+
+                    def readinto(_):
+                        return len(f.read(size))
+
+                while (
+                    not event_is_set(self._shutdown_event)
+                    and (timeit.default_timer() - self.starttime) <= self.timeout
+                ):
+                    n = readinto(buf)
+                    if not n:
+                        break
+                    received += n
+                    self.result += n
+                    if bucket and bucket.take(n) < n:
+                        break
+                f.close()
+        except IOError:
+            pass
+        except HTTP_ERRORS:
+            pass
+        return received
+
+
+class HTTPUploaderData(object):
+    """File like object to improve cutting off the upload once the timeout
+    has been reached
+
+    When provided, ``payload`` is a shared, read only buffer (usually a
+    ``memoryview`` slice) that is served from this object's own read
+    offset instead of pre allocating a private copy of the data. Bytes
+    read are taken from the ``TokenBucket`` ``bucket``, when given
+    """
+
+    def __init__(
+        self, length, start, timeout, shutdown_event=None, payload=None, bucket=None
+    ):
+        self.length = length
+        self.start = start
+        self.timeout = timeout
+        self.bucket = bucket
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+        self._data = None
+        self._payload = payload
+        self._offset = 0
+
+        self.total = [0]
+
+    @staticmethod
+    def build_payload(length):
+        """Build the ``length`` bytes of form data sent by an upload"""
+        chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+        multiplier = int(round(int(length) / 36.0))
+        try:
+            return ("content1=%s" % (chars * multiplier)[0 : int(length) - 9]).encode()
+        except MemoryError:
+            raise SpeedtestCLIError(
+                "Insufficient memory to pre-allocate upload data. Please "
+                "use --no-pre-allocate"
+            )
+
+    def pre_allocate(self):
+        if self._payload is not None:
+            return
+        IO = BytesIO or StringIO
+        self._data = IO(self.build_payload(self.length))
+
+    @property
+    def data(self):
+        if not self._data:
+            self.pre_allocate()
+        return self._data
+
+    def read(self, n=10240):
+        if (timeit.default_timer() - self.start) <= self.timeout and not event_is_set(
+            self._shutdown_event
+        ):
+            if self.bucket:
+                n = self.bucket.take(n)
+                if not n:
+                    raise SpeedtestUploadTimeout()
+            if self._payload is not None:
+                offset = self._offset
+                chunk = self._payload[offset : offset + n]
+                self._offset = offset + len(chunk)
+            else:
+                chunk = self.data.read(n)
+            self.total.append(len(chunk))
+            return chunk
+        else:
+            raise SpeedtestUploadTimeout()
+
+    def __len__(self):
+        return self.length
+
+
+class HTTPUploader(threading.Thread):
+    """Thread class for putting URLs
+
+    An uploader is a long lived worker that services ``(i, (request, size))``
+    tuples from the ``requests`` queue until it receives a ``None``
+    sentinel, placing an ``(i, bytes_sent)`` tuple on ``results`` for
+    every request it services
+
+    ``result`` holds a running count of the bytes sent by the requests
+    this thread has finished, and ``first_byte`` is the time the first
+    response arrived
+    """
+
+    def __init__(
+        self,
+        i,
+        requests,
+        results,
+        start,
+        timeout,
+        opener=None,
+        shutdown_event=None,
+        callback=do_nothing,
+        request_count=0,
+    ):
+        threading.Thread.__init__(self)
+        self.requests = requests
+        self.results = results
         self.result = 0
+        self.first_byte = None
+        self.starttime = start
         self.timeout = timeout
         self.i = i
+        self._callback = callback
+        self._request_count = request_count
+        # Finished bytes and the data in flight, swapped together
+        self._state = (0, None)
 
         if opener:
             self._opener = opener.open
@@ -934,11 +1926,45 @@ class HTTPUploader(threading.Thread):
             self._shutdown_event = FakeShutdownEvent()
 
     def run(self):
-        request = self.request
+        while 1:
+            item = self.requests.get(True)
+            if item is None:
+                break
+            i, (request, size) = item
+            sent = 0
+            try:
+                self._callback(i, self._request_count, start=True)
+                self._state = (self.result, request.data)
+                sent = self.send(request, size)
+            except Exception:
+                # Any failed request must leave the worker alive, or the
+                # requests queued behind it would never be serviced
+                printer("ERROR: %r" % get_exception(), debug=True)
+                sent = sum(request.data.total)
+            finally:
+                self.result += sent
+                self._state = (self.result, None)
+                self.results.put((i, sent), True)
+
+    def transferred(self):
+        """Return the number of bytes sent so far by this thread,
+        including those of the request in flight
+        """
+        result, data = self._state
+        if data is None:
+            return result
+        return result + sum(data.total)
+
+    def send(self, request, size):
+        """POST a single request, returning the number of bytes sent"""
+        data = request.data
+        data.start = self.starttime
         try:
             if (
-                timeit.default_timer() - self.starttime
-            ) <= self.timeout and not event_is_set(self._shutdown_event):
+                (timeit.default_timer() - self.starttime) <= self.timeout
+                and not event_is_set(self._shutdown_event)
+                and not (data.bucket and data.bucket.exhausted)
+            ):
                 try:
                     f = self._opener(request)
                 except TypeError:
@@ -946,18 +1972,300 @@ class HTTPUploader(threading.Thread):
                     # This also causes issues with Ctrl-C, but we will concede
                     # for the moment that Ctrl-C on PY24 isn't immediate
                     request = build_request(
-                        self.request.get_full_url(), data=request.data.read(self.size)
+                        request.get_full_url(), data=data.read(size)
                     )
                     f = self._opener(request)
-                f.read(11)
+                if self.first_byte is None:
+                    self.first_byte = timeit.default_timer()
+                f.read()
                 f.close()
-                self.result = sum(self.request.data.total)
+                return sum(data.total)
             else:
-                self.result = 0
+                return 0
         except (IOError, SpeedtestUploadTimeout):
-            self.result = sum(self.request.data.total)
+            return sum(data.total)
         except HTTP_ERRORS:
-            self.result = 0
+            return 0
+
+
+class HTTPPinger(threading.Thread):
+    """Thread class for measuring the latency to a server with a number of
+    ``latency.txt`` requests, each made on a new connection
+
+    Failed probes are recorded as ``None``. A ``(server, samples)`` tuple
+    is placed on ``results`` once all probes have been made, or once
+    stopped
+    """
+
+    def __init__(
+        self,
+        server,
+        results,
+        count=3,
+        source_address=None,
+        timeout=10,
+        user_agent=None,
+        shutdown_event=None,
+        resolver=None,
+        tls=None,
+    ):
+        threading.Thread.__init__(self)
+        # Probes abandoned by an early server selection must not keep
+        # the process alive
+        self.daemon = True
+        self.server = server
+        self.results = results
+        self.count = count
+        self.timeout = timeout
+        self.user_agent = user_agent or build_user_agent()
+        self.resolver = resolver
+        self.tls = tls
+        self._connection = None
+        self._done = threading.Event()
+
+        if source_address:
+            self.source_address = (source_address, 0)
+        else:
+            self.source_address = None
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def run(self):
+        samples = []
+        try:
+            url = os.path.dirname(self.server["url"])
+            stamp = int(timeit.time.time() * 1000)
+            latency_url = "%s/latency.txt?x=%s" % (url, stamp)
+            for i in range(0, self.count):
+                if event_is_set(self._done) or event_is_set(self._shutdown_event):
+                    break
+                samples.append(self.probe("%s.%s" % (latency_url, i)))
+        finally:
+            self.results.put((self.server, samples))
+
+    def probe(self, url):
+        """Make a single latency request, returning the time taken in
+        seconds or ``None`` on failure
+        """
+        printer("%s %s" % ("GET", url), debug=True)
+        urlparts = urlparse(url)
+        h = None
+        try:
+            try:
+                if urlparts[0] == "https":
+                    h = SpeedtestHTTPSConnection(
+                        urlparts[1],
+                        source_address=self.source_address,
+                        timeout=self.timeout,
+                        resolver=self.resolver,
+                        tls=self.tls,
+                    )
+                else:
+                    h = SpeedtestHTTPConnection(
+                        urlparts[1],
+                        source_address=self.source_address,
+                        timeout=self.timeout,
+                        resolver=self.resolver,
+                    )
+                self._connection = h
+                if event_is_set(self._done):
+                    return None
+                headers = {"User-Agent": self.user_agent}
+                path = "%s?%s" % (urlparts[2], urlparts[4])
+                start = timeit.default_timer()
+                h.request("GET", path, headers=headers)
+                r = h.getresponse()
+                total = timeit.default_timer() - start
+                text = r.read(9)
+            except HTTP_ERRORS + (HTTPException,):
+                e = get_exception()
+                printer("ERROR: %r" % e, debug=True)
+                return None
+        finally:
+            self._connection = None
+            if h is not None:
+                h.close()
+
+        if int(r.status) == 200 and text == "test=test".encode():
+            return total
+        return None
+
+    def stop(self):
+        """Stop probing, aborting the probe in flight"""
+        self._done.set()
+        h = self._connection
+        sock = h is not None and h.sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, ValueError):
+                pass
+
+
+class LatencyProber(threading.Thread):
+    """Thread class measuring the latency to a server with ``latency.txt``
+    requests made every ``interval`` seconds over a dedicated kept alive
+    connection, until stopped
+
+    Latencies in seconds are recorded in ``samples``, and failed probes
+    counted in ``failed``
+    """
+
+    def __init__(
+        self,
+        server,
+        interval=0.1,
+        source_address=None,
+        timeout=10,
+        secure=False,
+        shutdown_event=None,
+        resolver=None,
+        tls=None,
+    ):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = "%s/latency.txt" % os.path.dirname(server["url"])
+        self.interval = interval
+        self.source_address = source_address
+        self.timeout = timeout
+        self.secure = secure
+        self.resolver = resolver
+        self.tls = tls
+        self.samples = array.array("d")
+        self.failed = 0
+        self._done = threading.Event()
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def run(self):
+        opener = SpeedtestPersistentOpener(
+            self.source_address, self.timeout, self.resolver, self.tls
+        )
+        i = 0
+        try:
+            while not event_is_set(self._done) and not event_is_set(
+                self._shutdown_event
+            ):
+                begin = timeit.default_timer()
+                latency = self.probe(opener, i)
+                i += 1
+                if latency is None:
+                    self.failed += 1
+                else:
+                    self.samples.append(latency)
+                delay = self.interval - (timeit.default_timer() - begin)
+                if delay > 0:
+                    self._done.wait(delay)
+        finally:
+            opener.close()
+
+    def probe(self, opener, i):
+        """Make a single latency request, returning the time taken in
+        seconds or ``None`` on failure
+        """
+        request = build_request(self.url, bump=i, secure=self.secure)
+        try:
+            start = timeit.default_timer()
+            f = opener.open(request)
+            text = f.read()
+            total = timeit.default_timer() - start
+        except HTTP_ERRORS + (HTTPException,):
+            e = get_exception()
+            printer("ERROR: %r" % e, debug=True)
+            # The connection may be left mid response, so the next probe
+            # starts over on a new one
+            opener.close()
+            return None
+        if text[:9] == "test=test".encode():
+            return total
+        return None
+
+    def stop(self):
+        """Stop probing once the probe in flight completes"""
+        self._done.set()
+        while thread_is_alive(self):
+            self.join(0.1)
+
+
+def cpu_time():
+    """Return the user and system CPU time used by this process, every
+    thread included, in seconds
+    """
+
+    process_time = getattr(timeit.time, "process_time", None)
+    if process_time:
+        return process_time()
+    # PY32 and older, with the resolution of the clock tick
+    times = os.times()
+    return times[0] + times[1]
+
+
+def profiled(phase):
+    """Decorate a method to record its wall and CPU time as ``phase`` in
+    the ``SpeedtestProfile`` of its instance, when profiling
+    """
+
+    def decorator(func):
+        def inner(self, *args, **kwargs):
+            profile = self.profile
+            if profile is None:
+                return func(self, *args, **kwargs)
+            began = profile.begin()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                profile.end(phase, began)
+
+        inner.__name__ = func.__name__
+        inner.__doc__ = func.__doc__
+        return inner
+
+    return decorator
+
+
+class SpeedtestProfile(object):
+    """Wall and CPU time spent in each phase of a speedtest, as recorded
+    by the methods decorated with ``profiled``, and the threads of its
+    transfers, as recorded by ``run_transfer``
+
+    Phases may nest, ``get_best_server`` including ``get_closest_servers``
+    when it has to find them itself. CPU time is that of this process, not
+    of any ``SpeedtestProcess`` workers. Times are reported in ms
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.transfers = {}
+
+    def begin(self):
+        return timeit.default_timer(), cpu_time()
+
+    def end(self, phase, began):
+        entry = self.phases.setdefault(phase, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+        entry["wall"] += timeit.default_timer() - began[0]
+        entry["cpu"] += cpu_time() - began[1]
+        entry["calls"] += 1
+
+    def transfer(self, direction):
+        """Return the dict the ``direction`` transfer is recorded in"""
+        self.transfers[direction] = {}
+        return self.transfers[direction]
+
+    def dict(self):
+        phases = {}
+        for phase, entry in self.phases.items():
+            phases[phase] = {
+                "wall": round(entry["wall"] * 1000.0, 3),
+                "cpu": round(entry["cpu"] * 1000.0, 3),
+                "calls": entry["calls"],
+            }
+        return {"phases": phases, "transfers": self.transfers}
 
 
 class SpeedtestResults(object):
@@ -982,6 +2290,7 @@ class SpeedtestResults(object):
         client=None,
         opener=None,
         secure=False,
+        source=None,
     ):
         self.download = download
         self.upload = upload
@@ -991,11 +2300,21 @@ class SpeedtestResults(object):
         else:
             self.server = server
         self.client = client or {}
+        self.source = source
 
         self._share = None
         self.timestamp = "%sZ" % datetime.datetime.utcnow().isoformat()
         self.bytes_received = 0
         self.bytes_sent = 0
+        self.latency = {}
+        self.throughput = {}
+        self.cap = {}
+        self.loaded_latency = {}
+        self.servers = []
+        self.dns = {}
+        self.dual_stack = {}
+        self.handshakes = []
+        self.profile = None
 
         if opener:
             self._opener = opener
@@ -1077,10 +2396,13 @@ class SpeedtestResults(object):
     def dict(self):
         """Return dictionary of result data"""
 
-        return {
+        data = {
             "download": self.download,
             "upload": self.upload,
             "ping": self.ping,
+            "latency": self.latency,
+            "throughput": self.throughput,
+            "dns": self.dns,
             "server": self.server,
             "timestamp": self.timestamp,
             "bytes_sent": self.bytes_sent,
@@ -1088,6 +2410,42 @@ class SpeedtestResults(object):
             "share": self._share,
             "client": self.client,
         }
+        # Measurements of optional modes are only included when the mode
+        # was used, so that the output does not grow for consumers that did
+        # not ask for them
+        optional = (
+            ("cap", self.cap),
+            ("loaded_latency", self.loaded_latency),
+            ("bufferbloat", self.bufferbloat()),
+            ("servers", self.servers),
+            ("dual_stack", self.dual_stack),
+            ("tls", handshake_stats(self.handshakes)),
+            ("profile", self.profile and self.profile.dict()),
+            ("source", self.source),
+        )
+        for key, value in optional:
+            if value:
+                data[key] = value
+        return data
+
+    def bufferbloat(self):
+        """Return the bufferbloat grade, from the largest increase of the
+        median latency under load over the idle latency, or ``None`` when
+        latency under load was not measured
+        """
+
+        loaded = [
+            self.loaded_latency[direction]["p50"]
+            for direction in ("download", "upload")
+            if self.loaded_latency.get(direction)
+        ]
+        if not loaded:
+            return None
+        if self.loaded_latency.get("idle"):
+            idle = self.loaded_latency["idle"]["p50"]
+        else:
+            idle = self.latency.get("median", self.ping)
+        return bufferbloat_grade(max(loaded) - idle)
 
     @staticmethod
     def csv_header(delimiter=","):
@@ -1104,6 +2462,17 @@ class SpeedtestResults(object):
             "Upload",
             "Share",
             "IP Address",
+            "Idle Latency",
+            "Download Latency",
+            "Upload Latency",
+            "Bufferbloat",
+            "Source",
+            "IPv4 Ping",
+            "IPv4 Download",
+            "IPv4 Upload",
+            "IPv6 Ping",
+            "IPv6 Download",
+            "IPv6 Upload",
         ]
         out = StringIO()
         writer = csv.writer(out, delimiter=delimiter, lineterminator="")
@@ -1128,6 +2497,14 @@ class SpeedtestResults(object):
             self._share or "",
             self.client["ip"],
         ]
+        for phase in ("idle", "download", "upload"):
+            row.append(self.loaded_latency.get(phase, {}).get("p50", ""))
+        row.append(self.bufferbloat() or "")
+        row.append(self.source or "")
+        for family in ("ipv4", "ipv6"):
+            entry = self.dual_stack.get(family, {})
+            for key in ("ping", "download", "upload"):
+                row.append(entry.get(key, ""))
         writer.writerow([to_utf8(v) for v in row])
         return out.getvalue()
 
@@ -1140,22 +2517,793 @@ class SpeedtestResults(object):
         return json.dumps(self.dict(), **kwargs)
 
 
-class Speedtest(object):
-    """Class for performing standard speedtest.net testing operations"""
+def user_directory():
+    """Return the default directory of the cache, the store and the
+    history, which belongs to the current user alone
+    """
 
-    def __init__(
-        self,
-        config=None,
-        source_address=None,
-        timeout=10,
-        secure=False,
-        shutdown_event=None,
-    ):
-        self.config = {}
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or tempfile.gettempdir()
+        return os.path.join(base, "speedtest-cli")
+
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        home = os.path.expanduser("~")
+        if home != "~":
+            base = os.path.join(home, ".cache")
+    if base:
+        return os.path.join(base, "speedtest-cli")
+    # The temporary directory is shared with other users, which are kept
+    # out by private_directory
+    return os.path.join(tempfile.gettempdir(), "speedtest-cli-%d" % os.getuid())
+
+
+def private_directory(path):
+    """Create the directory ``path`` accessible by the current user alone,
+    or check that the existing directory is owned by the current user and
+    not writable by anyone else, raising ``OSError`` if it is not
+
+    Files read from or written to a directory that other users can write
+    to could be planted, or replaced by symlinks to other files
+    """
+
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    if not hasattr(os, "getuid"):
+        # Windows, where the default directory is per user
+        return
+    uid = os.getuid()
+    link = os.lstat(path)
+    target = os.stat(path)
+    if (
+        link.st_uid != uid
+        or target.st_uid != uid
+        or not stat.S_ISDIR(target.st_mode)
+        or target.st_mode & 0o022
+    ):
+        raise OSError(
+            errno.EACCES,
+            "Not owned by the current user, or writable by others",
+            path,
+        )
+
+
+def atomic_write(filename, data):
+    """Write the text ``data`` to ``filename`` through a temporary file
+    renamed over it, so readers never see a partial file
+    """
+
+    directory = os.path.dirname(filename) or os.curdir
+    private_directory(directory)
+    fd, tmp = tempfile.mkstemp(
+        prefix="%s." % os.path.basename(filename), suffix=".tmp", dir=directory
+    )
+    f = os.fdopen(fd, "w")
+    try:
+        try:
+            f.write(data)
+        finally:
+            f.close()
+    except (IOError, OSError):
+        os.remove(tmp)
+        raise
+    try:
+        os.rename(tmp, filename)
+    except OSError:
+        # Windows will not rename over an existing file
+        os.remove(filename)
+        os.rename(tmp, filename)
+
+
+class SpeedtestCache(object):
+    """Local on disk cache for the speedtest.net configuration and server
+    list
+
+    Entries are stored pre-parsed as JSON, alongside the ``ETag`` and
+    ``Last-Modified`` validators of the response they were parsed from,
+    so that an entry older than ``ttl`` seconds can be revalidated with a
+    conditional request instead of being downloaded and parsed again
+    """
+
+    server_fields = (
+        "id",
+        "lat",
+        "lon",
+        "url",
+        "host",
+        "sponsor",
+        "name",
+        "country",
+        "cc",
+    )
+
+    def __init__(self, path=None, ttl=3600):
+        if not json:
+            raise SpeedtestException(
+                "The json/simplejson python module is required to cache "
+                "the speedtest.net configuration and server list"
+            )
+        self.path = path or user_directory()
+        self.ttl = ttl
+
+    def _filename(self, name):
+        return os.path.join(self.path, "%s.json" % name)
+
+    def load(self, name):
+        """Return the cache entry ``name``, or ``None`` if there is no
+        usable entry
+        """
+        try:
+            private_directory(self.path)
+            f = open(self._filename(name))
+            try:
+                entry = json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or "data" not in entry:
+            return None
+        return entry
+
+    def fresh(self, entry):
+        """Whether ``entry`` is younger than the TTL"""
+        age = timeit.time.time() - entry.get("stored", 0)
+        return 0 <= age < self.ttl
+
+    @staticmethod
+    def conditional_headers(entry):
+        """Headers for a conditional request revalidating ``entry``"""
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, name, data, response=None, url=None):
+        """Store ``data`` as the cache entry ``name``, along with the
+        validators of ``response``, returning the new entry
+        """
+        entry = {"stored": timeit.time.time(), "url": url, "data": data}
+        if response is not None:
+            entry["etag"] = get_response_header(response, "etag")
+            entry["last_modified"] = get_response_header(response, "last-modified")
+        self._write(name, entry)
+        return entry
+
+    def touch(self, name, entry):
+        """Mark ``entry`` as revalidated, restarting its TTL"""
+        entry["stored"] = timeit.time.time()
+        self._write(name, entry)
+
+    def _write(self, name, entry):
+        filename = self._filename(name)
+        try:
+            atomic_write(filename, json.dumps(entry, separators=(",", ":")))
+        except (IOError, OSError):
+            e = get_exception()
+            printer("Unable to write cache %s: %s" % (filename, e), debug=True)
+
+    @classmethod
+    def pack_servers(cls, servers):
+        """Pack server attribute dicts into compact rows"""
+        return [
+            [server.get(field, "") for field in cls.server_fields] for server in servers
+        ]
+
+    @classmethod
+    def unpack_servers(cls, rows):
+        """Unpack compact rows into server attribute dicts"""
+        fields = cls.server_fields
+        return [dict(zip(fields, row)) for row in rows]
+
+
+class SpeedtestStore(object):
+    """Rolling local store of the results of the latest ``size`` tests
+
+    Results are kept as lines of JSON in ``results.jsonl``, and the latest
+    of them alone in ``latest.json``, so it can be read back without
+    running a test or reading the whole store
+    """
+
+    def __init__(self, path=None, size=1000):
+        if not json:
+            raise SpeedtestException(
+                "The json/simplejson python module is required to store results"
+            )
+        self.path = path or user_directory()
+        self.size = size
+
+    def _filename(self, name):
+        return os.path.join(self.path, name)
+
+    def append(self, result):
+        """Append the ``result`` dict, dropping the oldest results beyond
+        the size of the store
+        """
+        line = json.dumps(result, separators=(",", ":"))
+        lines = (self.lines() + [line])[-self.size :]
+        try:
+            atomic_write(
+                self._filename("results.jsonl"), "".join("%s\n" % l for l in lines)
+            )
+            atomic_write(self._filename("latest.json"), line)
+        except (IOError, OSError):
+            e = get_exception()
+            printer("Unable to store results in %s: %s" % (self.path, e), error=True)
+
+    def lines(self):
+        """Return the stored results, oldest first, as lines of JSON"""
+        try:
+            private_directory(self.path)
+            f = open(self._filename("results.jsonl"))
+            try:
+                return [line for line in f.read().splitlines() if line]
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return []
+
+    def latest(self):
+        """Return the latest stored result, or ``None``"""
+        try:
+            private_directory(self.path)
+            f = open(self._filename("latest.json"))
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return None
+
+
+class SpeedtestHistory(object):
+    """Append-only history of test results as fixed width binary records,
+    queried by memory mapping the file
+
+    Records are appended in time order, so the start of a query window is
+    found with a binary search on the timestamps, and only the records
+    within the window are unpacked
+    """
+
+    fields = (
+        "timestamp",
+        "server",
+        "ping",
+        "download",
+        "upload",
+        "bytes_received",
+        "bytes_sent",
+    )
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(user_directory(), "history.bin")
+        self.header_size = struct.calcsize(HISTORY_HEADER)
+        self.record_size = struct.calcsize(HISTORY_RECORD)
+
+    def append(self, results, timestamp=None):
+        """Append a record of ``results``, at ``timestamp`` or now"""
+        if timestamp is None:
+            timestamp = timeit.time.time()
+        try:
+            server = int(results.server.get("id") or 0)
+        except ValueError:
+            server = 0
+        record = struct.pack(
+            HISTORY_RECORD,
+            timestamp,
+            server,
+            results.ping,
+            results.download,
+            results.upload,
+            results.bytes_received,
+            results.bytes_sent,
+        )
+        try:
+            private_directory(os.path.dirname(self.path) or os.curdir)
+            fd = os.open(
+                self.path,
+                os.O_RDWR
+                | os.O_CREAT
+                | getattr(os, "O_NOFOLLOW", 0)
+                | getattr(os, "O_BINARY", 0),
+                0o600,
+            )
+            f = os.fdopen(fd, "r+b")
+            try:
+                f.seek(0, 2)
+                size = f.tell()
+                if size < self.header_size:
+                    # A new file, or one torn within its header
+                    f.seek(0)
+                    f.truncate()
+                    record = (
+                        struct.pack(HISTORY_HEADER, HISTORY_MAGIC, self.record_size)
+                        + record
+                    )
+                else:
+                    f.seek(0)
+                    self._check_header(f.read(self.header_size))
+                    # Drop a partially written last record, which would
+                    # otherwise misalign every record appended after it
+                    end = size - (size - self.header_size) % self.record_size
+                    if end != size:
+                        f.truncate(end)
+                    f.seek(end)
+                f.write(record)
+            finally:
+                f.close()
+        except (IOError, OSError, SpeedtestException):
+            e = get_exception()
+            printer("Unable to append to history %s: %s" % (self.path, e), error=True)
+
+    def _check_header(self, header):
+        magic, record_size = struct.unpack_from(HISTORY_HEADER, header)
+        if magic != HISTORY_MAGIC or record_size != self.record_size:
+            raise SpeedtestException("Unrecognized history file %s" % self.path)
+
+    def _records(self, mapped, since):
+        """Yield the records of ``mapped`` from ``since`` on as tuples"""
+        self._check_header(mapped)
+        # A partially written last record is ignored
+        count = (len(mapped) - self.header_size) // self.record_size
+
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self.header_size + mid * self.record_size
+            if struct.unpack_from("<d", mapped, offset)[0] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        for i in range(lo, count):
+            yield struct.unpack_from(
+                HISTORY_RECORD, mapped, self.header_size + i * self.record_size
+            )
+
+    def query(self, since, window=86400):
+        """Summarize the records from ``since`` on with the p5, median and
+        p95 of the ping, download and upload, the latest record, and for
+        each record the rolling medians over the ``window`` seconds up to it
+        """
+        columns = dict((field, array.array("d")) for field in self.fields)
+        rolling = []
+        latest = None
+        try:
+            private_directory(os.path.dirname(self.path) or os.curdir)
+            f = open(self.path, "rb")
+        except (IOError, OSError):
+            f = None
+        if f is not None:
+            try:
+                try:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, EnvironmentError):
+                    # Empty file
+                    mapped = None
+                if mapped is not None and len(mapped) >= self.header_size:
+                    try:
+                        # Records from up to ``window`` before ``since`` fill
+                        # the windows of the first records
+                        for record in self._records(mapped, since - window):
+                            for field, value in zip(self.fields, record):
+                                columns[field].append(value)
+                            latest = record
+                    finally:
+                        mapped.close()
+            finally:
+                f.close()
+
+        timestamps = columns["timestamp"]
+        first = 0
+        while first < len(timestamps) and timestamps[first] < since:
+            first += 1
+        if first == len(timestamps):
+            latest = None
+
+        # The window of each record is [timestamp - window, timestamp], its
+        # start found by advancing a second index over the sorted timestamps
+        start = 0
+        for i in range(first, len(timestamps)):
+            while timestamps[start] < timestamps[i] - window:
+                start += 1
+            entry = {"timestamp": timestamps[i], "records": i + 1 - start}
+            for field in ("ping", "download", "upload"):
+                entry[field] = percentile(columns[field][start : i + 1], 50)
+            rolling.append(entry)
+
+        summary = {
+            "since": since,
+            "records": len(timestamps) - first,
+            "latest": latest and dict(zip(self.fields, latest)),
+            "rolling": rolling,
+        }
+        for field in ("ping", "download", "upload"):
+            values = columns[field][first:]
+            summary[field] = {
+                "p5": percentile(values, 5),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+            }
+        return summary
+
+
+def run_transfer(
+    worker,
+    requests,
+    max_threads,
+    timeout,
+    callback=do_nothing,
+    opener=None,
+    source_address=None,
+    socket_timeout=10,
+    shutdown_event=None,
+    keep_alive=False,
+    sampler=None,
+    refill=None,
+    ramp=None,
+    shards=None,
+    profile=None,
+    resolver=None,
+    tls=None,
+    **kwargs
+):
+    """Service ``requests`` with a pool of at most ``max_threads`` long
+    lived ``worker`` threads fed from a queue
+
+    With ``keep_alive`` each worker sends all of its requests over a
+    single persistent connection to ``source_address``, otherwise all of
+    them share ``opener``. A ``ThroughputSampler`` given as ``sampler``
+    samples the bytes transferred by the pool for the duration of the
+    transfer. Any additional keyword arguments are passed through to
+    ``worker``
+
+    With ``refill``, the queue is kept fed with ``refill(i, shard)``
+    requests once ``requests`` run low, until ``shutdown_event`` is set or
+    ``refill`` returns ``None``
+
+    With a ``ConcurrencyRamp`` as ``ramp``, listening to ``sampler``, the
+    pool starts with the ramp's streams instead of ``max_threads``, and
+    grows as the ramp decides
+
+    With ``shards``, a list of one ``0`` count per server, request ``i`` is
+    made to server ``i % len(shards)``. Every thread is bound to a single
+    server, at least one per server, servicing a queue of its own so kept
+    alive connections are not torn down, and refilled requests are made
+    to the server of the request they replace. The counts are set to the
+    bytes transferred with each server
+
+    With a ``profile`` dict, the wall and CPU time of the transfer, the
+    time spent creating and starting threads, and the time to the first
+    response and the bytes transferred of each thread are recorded in it
+
+    Returns the start time of the transfer, and a list of the number
+    of bytes transferred for each request
+    """
+
+    request_count = len(requests)
+    if ramp:
+        max_threads = ramp.streams
+
+    queues = [Queue() for _ in range(max(1, len(shards or ())))]
+    results = Queue()
+    shard_of = []
+    for i, request in enumerate(requests):
+        shard_of.append(i % len(queues))
+        queues[shard_of[i]].put((i, request))
+    queued = request_count
+
+    start = timeit.default_timer()
+    began = profile is not None and cpu_time()
+    pool = []
+    openers = []
+    spawning = [0.0]
+
+    def spawn(count):
+        for _ in range(count):
+            spawned = timeit.default_timer()
+            pending = queues[len(pool) % len(queues)]
+            if keep_alive:
+                thread_opener = SpeedtestPersistentOpener(
+                    source_address, socket_timeout, resolver, tls
+                )
+                openers.append(thread_opener)
+            else:
+                thread_opener = opener
+            thread = worker(
+                len(pool),
+                pending,
+                results,
+                start,
+                timeout,
+                opener=thread_opener,
+                shutdown_event=shutdown_event,
+                callback=callback,
+                request_count=request_count,
+                **kwargs
+            )
+            thread.start()
+            pool.append(thread)
+            spawning[0] += timeit.default_timer() - spawned
+            if not refill:
+                pending.put(None)
+
+    spawn(max(len(queues), min(max_threads, request_count)))
+    if ramp:
+        ramp.grow = spawn
+
+    if sampler:
+        sampler.counter = lambda: sum(thread.transferred() for thread in pool)
+        sampler.start()
+
+    finished = []
+    while len(finished) < queued:
+        # Wait with a timeout so that Ctrl-C is handled meanwhile, and stop
+        # waiting for results no worker is left to deliver
+        try:
+            i, transferred = results.get(True, 0.1)
+        except Empty:
+            if not [thread for thread in pool if thread_is_alive(thread)]:
+                break
+            continue
+        finished.append(transferred)
+        shard = shard_of[i]
+        if (
+            refill
+            and not event_is_set(shutdown_event)
+            and queues[shard].qsize() < len(pool[shard :: len(queues)])
+        ):
+            request = refill(queued, shard)
+            if request is None:
+                refill = None
+                for k in range(len(pool)):
+                    queues[k % len(queues)].put(None)
+            else:
+                queues[shard].put((queued, request))
+                shard_of.append(shard)
+                queued += 1
+        callback(len(finished) - 1, queued, end=True)
+
+    if sampler:
+        sampler.stop()
+    if refill:
+        for k in range(len(pool)):
+            queues[k % len(queues)].put(None)
+    for k, thread in enumerate(pool):
+        while thread_is_alive(thread):
+            thread.join(0.1)
+        if shards:
+            shards[k % len(queues)] += thread.transferred()
+    for thread_opener in openers:
+        thread_opener.close()
+
+    if profile is not None:
+        profile.update(
+            {
+                "wall": round((timeit.default_timer() - start) * 1000.0, 3),
+                "cpu": round((cpu_time() - began) * 1000.0, 3),
+                "threads": len(pool),
+                "thread_start": round(spawning[0] * 1000.0, 3),
+                "thread_start_mean": round(spawning[0] * 1000.0 / len(pool), 3),
+                "first_byte": latency_percentiles(
+                    [
+                        thread.first_byte - start
+                        for thread in pool
+                        if thread.first_byte is not None
+                    ]
+                ),
+                "thread_bytes": [thread.transferred() for thread in pool],
+            }
+        )
+
+    return start, finished
+
+
+def build_upload_requests(
+    url,
+    sizes,
+    length,
+    secure=False,
+    shutdown_event=None,
+    pre_allocate=True,
+    shared_payload=False,
+    bucket=None,
+    payload=None,
+):
+    """Build a ``(request, size)`` upload request to ``url`` for each of
+    ``sizes``, or round robin to each of a list of ``url``
+
+    With ``shared_payload`` a single payload of the largest upload size is
+    built, unless passed in as ``payload``, and every request is served
+    from a zero copy slice of it. The data of every request takes from the
+    ``TokenBucket`` ``bucket``
+    """
+
+    if not shared_payload:
+        payload = None
+    elif payload is None and sizes:
+        payload = memoryview(HTTPUploaderData.build_payload(max(sizes)))
+
+    if isinstance(url, list):
+        urls = url
+    else:
+        urls = [url]
+
+    requests = []
+    for i, size in enumerate(sizes):
+        # We set ``0`` for ``start`` and handle setting the actual
+        # ``start`` in ``HTTPUploader`` to get better measurements
+        data = HTTPUploaderData(
+            size,
+            0,
+            length,
+            shutdown_event=shutdown_event,
+            payload=payload and payload[:size],
+            bucket=bucket,
+        )
+        if pre_allocate:
+            data.pre_allocate()
+
+        headers = {"Content-length": size}
+        requests.append(
+            (
+                build_request(
+                    urls[i % len(urls)], data, secure=secure, headers=headers
+                ),
+                size,
+            )
+        )
+    return requests
+
+
+if multiprocessing:
+
+    class SpeedtestProcess(multiprocessing.Process):
+        """Process class running a share of a download or upload test
+
+        ``items`` are the ``(i, url)`` download or ``(i, size)`` upload
+        requests serviced by this process, with its own pool of
+        ``threads`` worker threads, so transfers are not bound by the GIL
+        of a single interpreter
+
+        Requests are built before waiting on the shared ``barrier``, so
+        all processes start transferring together. ``None`` is sent over
+        ``conn`` as each request completes, followed by a tuple of the
+        total number of bytes transferred, and the running totals sampled
+        every ``sample_interval`` seconds
+        """
+
+        def __init__(
+            self,
+            conn,
+            barrier,
+            direction,
+            url,
+            items,
+            length,
+            threads,
+            source_address=None,
+            timeout=10,
+            secure=False,
+            keep_alive=False,
+            buffer_size=65536,
+            pre_allocate=True,
+            shared_payload=False,
+            sample_interval=0.1,
+            resolver=None,
+            tls=None,
+        ):
+            multiprocessing.Process.__init__(self)
+            self.daemon = True
+            self.conn = conn
+            self.barrier = barrier
+            self.direction = direction
+            self.url = url
+            self.items = items
+            self.length = length
+            self.threads = threads
+            self.source_address = source_address
+            self.timeout = timeout
+            self.secure = secure
+            self.keep_alive = keep_alive
+            self.buffer_size = buffer_size
+            self.pre_allocate = pre_allocate
+            self.shared_payload = shared_payload
+            self.sample_interval = sample_interval
+            self.resolver = resolver
+            self.tls = tls
+
+        def run(self):
+            # The parent process handles interrupts, and terminates us
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            if self.tls is not None:
+                # Only report the handshakes made by this process
+                self.tls.handshakes = []
+
+            kwargs = {}
+            if self.direction == "download":
+                worker = HTTPDownloader
+                requests = [
+                    build_request(url, bump=i, secure=self.secure)
+                    for i, url in self.items
+                ]
+                kwargs["buffer_size"] = self.buffer_size
+            else:
+                worker = HTTPUploader
+                requests = build_upload_requests(
+                    self.url,
+                    [size for _, size in self.items],
+                    self.length,
+                    secure=self.secure,
+                    pre_allocate=self.pre_allocate,
+                    shared_payload=self.shared_payload,
+                )
+
+            def callback(current, total, start=False, end=False):
+                if end:
+                    self.conn.send(None)
+
+            try:
+                self.barrier.wait(PROCESS_START_TIMEOUT)
+            except threading.BrokenBarrierError:
+                return
+
+            sampler = None
+            samples = []
+            if self.sample_interval:
+                sampler = ThroughputSampler(self.sample_interval)
+            start, finished = run_transfer(
+                worker,
+                requests,
+                self.threads,
+                self.length,
+                callback,
+                opener=build_opener(
+                    self.source_address, self.timeout, self.resolver, self.tls
+                ),
+                source_address=self.source_address,
+                socket_timeout=self.timeout,
+                keep_alive=self.keep_alive,
+                sampler=sampler,
+                resolver=self.resolver,
+                tls=self.tls,
+                **kwargs
+            )
+            if sampler:
+                samples = list(sampler.samples)
+            handshakes = self.tls and self.tls.handshakes or []
+            self.conn.send((sum(finished), samples, handshakes))
+            self.conn.close()
 
-        self._source_address = source_address
-        self._timeout = timeout
-        self._opener = build_opener(source_address, timeout)
+
+class Speedtest(object):
+    """Class for performing standard speedtest.net testing operations"""
+
+    def __init__(
+        self,
+        config=None,
+        source_address=None,
+        timeout=10,
+        secure=False,
+        shutdown_event=None,
+        cache=None,
+        profile=False,
+    ):
+        self.config = {}
+        self.profile = profile and SpeedtestProfile() or None
+
+        self._cache = cache
+        self._source_address = source_address
+        self._timeout = timeout
+        self._resolver = SpeedtestResolver(source_address)
+        self._family = None
+        self._tls = SpeedtestTLS()
+        self._opener = build_opener(source_address, timeout, self._resolver, self._tls)
 
         self._secure = secure
 
@@ -1168,15 +3316,19 @@ class Speedtest(object):
         if config is not None:
             self.config.update(config)
 
-        self.servers = {}
+        self.servers = ServerIndex()
         self.closest = []
+        self.ranked = []
         self._best = {}
 
         self.results = SpeedtestResults(
             client=self.config["client"],
             opener=self._opener,
             secure=secure,
+            source=source_address,
         )
+        self.results.handshakes = self._tls.handshakes
+        self.results.profile = self.profile
 
     @property
     def best(self):
@@ -1184,14 +3336,50 @@ class Speedtest(object):
             self.get_best_server()
         return self._best
 
+    def new_results(self):
+        """Start new ``results``, and a new profile when profiling, for
+        another test with this instance, carrying the best server and its
+        latency over
+        """
+
+        previous = self.results
+        self.results = SpeedtestResults(
+            server=previous.server,
+            client=self.config["client"],
+            opener=self._opener,
+            secure=self._secure,
+            source=self._source_address,
+        )
+        self._tls.handshakes = self.results.handshakes
+        self.results.ping = previous.ping
+        self.results.latency = previous.latency
+        if self.profile is not None:
+            self.profile = SpeedtestProfile()
+        self.results.profile = self.profile
+        return self.results
+
+    @profiled("get_config")
     def get_config(self):
         """Download the speedtest.net configuration and return only the data
         we are interested in
+
+        When a cache is in use, a cached configuration younger than the
+        cache TTL is used as is, and an expired one is revalidated with a
+        conditional request
         """
 
+        entry = None
+        if self._cache:
+            entry = self._cache.load("config")
+            if entry and self._cache.fresh(entry):
+                printer("Using cached configuration", debug=True)
+                return self._set_config(**entry["data"])
+
         headers = {}
-        if gzip:
+        if zlib:
             headers["Accept-Encoding"] = "gzip"
+        if entry:
+            headers.update(self._cache.conditional_headers(entry))
         request = build_request(
             "https://www.speedtest.net/speedtest-config.php",
             headers=headers,
@@ -1199,6 +3387,10 @@ class Speedtest(object):
         )
         uh, e = catch_request(request, opener=self._opener)
         if e:
+            if entry and getattr(e, "code", None) == 304:
+                printer("Cached configuration not modified", debug=True)
+                self._cache.touch("config", entry)
+                return self._set_config(**entry["data"])
             raise ConfigRetrievalError(e)
         configxml_list = []
 
@@ -1249,6 +3441,25 @@ class Speedtest(object):
             # times = get_attributes_by_tag_name(root, 'times')
             client = get_attributes_by_tag_name(root, "client")
 
+        if self._cache:
+            self._cache.store(
+                "config",
+                {
+                    "client": client,
+                    "server_config": server_config,
+                    "download": download,
+                    "upload": upload,
+                },
+                response=uh,
+            )
+
+        return self._set_config(client, server_config, download, upload)
+
+    def _set_config(self, client, server_config, download, upload):
+        """Build the configuration we are interested in from the attributes
+        of the speedtest.net configuration
+        """
+
         ignore_servers = [int(i) for i in server_config["ignoreids"].split(",") if i]
 
         ratio = int(upload["ratio"])
@@ -1299,9 +3510,14 @@ class Speedtest(object):
 
         return self.config
 
-    def get_servers(self, servers=None, exclude=None):
+    @profiled("get_servers")
+    def get_servers(self, servers=None, exclude=None, limit=None):
         """Retrieve a the list of speedtest.net servers, optionally filtered
         to servers matching those specified in the ``servers`` argument
+
+        The server list is parsed as it is received, and filters are
+        applied to each server as it is parsed. With a ``limit``, only the
+        ``limit`` closest servers are kept
         """
         if servers is None:
             servers = []
@@ -1320,112 +3536,134 @@ class Speedtest(object):
                         "%s is an invalid server type, must be int" % s
                     )
 
-        urls = [
-            "://www.speedtest.net/speedtest-servers-static.php",
-            "http://c.speedtest.net/speedtest-servers-static.php",
-            "://www.speedtest.net/speedtest-servers.php",
-            "http://c.speedtest.net/speedtest-servers.php",
-        ]
-
-        headers = {}
-        if gzip:
-            headers["Accept-Encoding"] = "gzip"
+        servers = set(servers)
+        skip = set(exclude)
+        skip.update(self.config["ignore_servers"])
 
-        errors = []
-        for url in urls:
+        # Max-heap, through negated distances, of the closest servers
+        # seen so far when limited
+        nearest = []
+        for seq, attrib in enumerate(self._server_list()):
             try:
-                request = build_request(
-                    "%s?threads=%s" % (url, self.config["threads"]["download"]),
-                    headers=headers,
-                    secure=self._secure,
-                )
-                uh, e = catch_request(request, opener=self._opener)
-                if e:
-                    errors.append("%s" % e)
-                    raise ServersRetrievalError()
-
-                stream = get_response_stream(uh)
+                server_id = int(attrib.get("id"))
+            except (TypeError, ValueError):
+                continue
 
-                serversxml_list = []
-                while 1:
-                    try:
-                        serversxml_list.append(stream.read(1024))
-                    except (OSError, EOFError):
-                        raise ServersRetrievalError(get_exception())
-                    if len(serversxml_list[-1]) == 0:
-                        break
+            if servers and server_id not in servers:
+                continue
 
-                stream.close()
-                uh.close()
+            if server_id in skip:
+                continue
 
-                if int(uh.code) != 200:
-                    raise ServersRetrievalError()
+            try:
+                lat, lon = float(attrib.get("lat")), float(attrib.get("lon"))
+            except (TypeError, ValueError):
+                continue
 
-                serversxml = "".encode().join(serversxml_list)
+            if not limit:
+                # Distances are computed in a single batch by the index
+                self.servers.add(server_id, lat, lon, attrib)
+                continue
 
-                printer("Servers XML:\n%s" % serversxml, debug=True)
+            d = distance(self.lat_lon, (lat, lon))
+            if len(nearest) < limit:
+                heapq.heappush(nearest, (-d, seq, (server_id, lat, lon, attrib)))
+            elif d < -nearest[0][0]:
+                heapq.heapreplace(nearest, (-d, seq, (server_id, lat, lon, attrib)))
 
-                try:
-                    try:
-                        try:
-                            root = ET.fromstring(serversxml)
-                        except ET.ParseError:
-                            e = get_exception()
-                            raise SpeedtestServersError(
-                                "Malformed speedtest.net server list: %s" % e
-                            )
-                        elements = etree_iter(root, "server")
-                    except AttributeError:
-                        try:
-                            root = DOM.parseString(serversxml)
-                        except ExpatError:
-                            e = get_exception()
-                            raise SpeedtestServersError(
-                                "Malformed speedtest.net server list: %s" % e
-                            )
-                        elements = root.getElementsByTagName("server")
-                except (SyntaxError, xml.parsers.expat.ExpatError):
-                    raise ServersRetrievalError()
+        for _, _, server in sorted(nearest, key=lambda item: (-item[0], item[1])):
+            self.servers.add(*server)
 
-                for server in elements:
-                    try:
-                        attrib = server.attrib
-                    except AttributeError:
-                        attrib = dict(list(server.attributes.items()))
+        if (servers or exclude) and not self.servers:
+            raise NoMatchedServers()
 
-                    if servers and int(attrib.get("id")) not in servers:
-                        continue
+        return self.servers
 
-                    if (
-                        int(attrib.get("id")) in self.config["ignore_servers"]
-                        or int(attrib.get("id")) in exclude
-                    ):
-                        continue
+    def _server_list(self):
+        """Generate the attributes of every speedtest.net server, unfiltered,
+        as they are parsed
 
-                    try:
-                        d = distance(
-                            self.lat_lon,
-                            (float(attrib.get("lat")), float(attrib.get("lon"))),
-                        )
-                    except Exception:
-                        continue
+        When a cache is in use, a cached server list younger than the
+        cache TTL is used as is, and an expired one is revalidated with a
+        conditional request
+        """
 
-                    attrib["d"] = d
+        entry = None
+        if self._cache:
+            entry = self._cache.load("servers")
+            if entry and self._cache.fresh(entry):
+                printer("Using cached server list", debug=True)
+                for attrib in SpeedtestCache.unpack_servers(entry["data"]):
+                    yield attrib
+                return
 
-                    try:
-                        self.servers[d].append(attrib)
-                    except KeyError:
-                        self.servers[d] = [attrib]
+        urls = [
+            "://www.speedtest.net/speedtest-servers-static.php",
+            "http://c.speedtest.net/speedtest-servers-static.php",
+            "://www.speedtest.net/speedtest-servers.php",
+            "http://c.speedtest.net/speedtest-servers.php",
+        ]
 
-                break
+        errors = []
+        for url in urls:
+            headers = {}
+            if zlib:
+                headers["Accept-Encoding"] = "gzip"
+            if entry and entry.get("url") == url:
+                headers.update(self._cache.conditional_headers(entry))
+            request = build_request(
+                "%s?threads=%s" % (url, self.config["threads"]["download"]),
+                headers=headers,
+                secure=self._secure,
+            )
+            uh, e = catch_request(request, opener=self._opener)
+            if e:
+                if entry and getattr(e, "code", None) == 304:
+                    printer("Cached server list not modified", debug=True)
+                    self._cache.touch("servers", entry)
+                    for attrib in SpeedtestCache.unpack_servers(entry["data"]):
+                        yield attrib
+                    return
+                errors.append("%s" % e)
+                continue
 
-            except ServersRetrievalError:
+            if int(uh.code) != 200:
+                uh.close()
                 continue
 
-        if (servers or exclude) and not self.servers:
-            raise NoMatchedServers()
+            stream = get_response_stream(uh)
+            server_list = []
+            count = 0
+            try:
+                try:
+                    for attrib in iter_server_attributes(stream):
+                        if self._cache:
+                            server_list.append(attrib)
+                        count += 1
+                        yield attrib
+                except ServersRetrievalError:
+                    # Servers already generated cannot be taken back, so
+                    # only fall back to the next URL if nothing was parsed
+                    if count:
+                        raise
+                    errors.append("%s" % get_exception())
+                    continue
+            finally:
+                stream.close()
+                uh.close()
 
-        return self.servers
+            printer("Parsed %d servers from %s" % (count, url), debug=True)
+
+            if self._cache:
+                self._cache.store(
+                    "servers",
+                    SpeedtestCache.pack_servers(server_list),
+                    response=uh,
+                    url=url,
+                )
+            return
+
+        printer("Unable to retrieve server list: %r" % errors, debug=True)
 
     def set_mini_server(self, server):
         """Instead of querying for a list of servers, set a link to a
@@ -1482,29 +3720,29 @@ class Speedtest(object):
 
         return self.servers
 
+    @profiled("get_closest_servers")
     def get_closest_servers(self, limit=5):
         """Limit servers to the closest speedtest.net servers based on
         geographic distance
         """
 
         if not self.servers:
-            self.get_servers()
+            self.get_servers(limit=limit)
 
-        for d in sorted(self.servers.keys()):
-            for s in self.servers[d]:
-                self.closest.append(s)
-                if len(self.closest) == limit:
-                    break
-            else:
-                continue
-            break
+        self.closest = self.servers.closest(self.lat_lon, limit)
 
         printer("Closest Servers:\n%r" % self.closest, debug=True)
         return self.closest
 
-    def get_best_server(self, servers=None):
+    @profiled("get_best_server")
+    def get_best_server(self, servers=None, probe_timeout=None, rank=1):
         """Perform a speedtest.net "ping" to determine which speedtest.net
         server has the lowest latency
+
+        All servers are probed concurrently, and each probe is limited to
+        ``probe_timeout`` seconds, defaulting to the configured timeout.
+        Selection stops early once ``rank`` servers have answered every
+        probe and the remaining servers can no longer be close to them
         """
 
         if not servers:
@@ -1512,150 +3750,610 @@ class Speedtest(object):
                 servers = self.get_closest_servers()
             servers = self.closest
 
-        if self._source_address:
-            source_address_tuple = (self._source_address, 0)
-        else:
-            source_address_tuple = None
+        if probe_timeout is None:
+            probe_timeout = self._timeout
 
+        count = 3
         user_agent = build_user_agent()
 
-        results = {}
+        pending = Queue()
+        pingers = []
+        start = timeit.default_timer()
         for server in servers:
-            cum = []
-            url = os.path.dirname(server["url"])
-            stamp = int(timeit.time.time() * 1000)
-            latency_url = "%s/latency.txt?x=%s" % (url, stamp)
-            for i in range(0, 3):
-                this_latency_url = "%s.%s" % (latency_url, i)
-                printer("%s %s" % ("GET", this_latency_url), debug=True)
-                urlparts = urlparse(latency_url)
-                try:
-                    if urlparts[0] == "https":
-                        h = SpeedtestHTTPSConnection(
-                            urlparts[1], source_address=source_address_tuple
-                        )
-                    else:
-                        h = SpeedtestHTTPConnection(
-                            urlparts[1], source_address=source_address_tuple
-                        )
-                    headers = {"User-Agent": user_agent}
-                    path = "%s?%s" % (urlparts[2], urlparts[4])
-                    start = timeit.default_timer()
-                    h.request("GET", path, headers=headers)
-                    r = h.getresponse()
-                    total = timeit.default_timer() - start
-                except HTTP_ERRORS:
-                    e = get_exception()
-                    printer("ERROR: %r" % e, debug=True)
-                    cum.append(3600)
-                    continue
+            pinger = HTTPPinger(
+                server,
+                pending,
+                count=count,
+                source_address=self._source_address,
+                timeout=probe_timeout,
+                user_agent=user_agent,
+                shutdown_event=self._shutdown_event,
+                resolver=self._resolver,
+                tls=self._tls,
+            )
+            pinger.start()
+            pingers.append(pinger)
+
+        # Probes are made one after another per server, so no server can
+        # take longer than ``count`` probe timeouts
+        deadline = start + (probe_timeout * count) + 1
+        results = []
+        answered = 0
+        while len(results) < len(servers):
+            remaining = deadline - timeit.default_timer()
+            if remaining <= 0:
+                break
+            try:
+                server, samples = pending.get(True, remaining)
+            except Empty:
+                break
 
-                text = r.read(9)
-                if int(r.status) == 200 and text == "test=test".encode():
-                    cum.append(total)
-                else:
-                    cum.append(3600)
-                h.close()
+            avg, latencies = score_latencies(samples, count)
+            results.append((avg, server, latencies))
+
+            if len(latencies) == count:
+                answered += 1
+            if len(latencies) == count and answered == rank:
+                # All servers started probing at the same time, so any
+                # server not done shortly after the ``rank`` servers to
+                # answer every probe is slower than them. Only wait a grace
+                # period of 25% for close contenders
+                grace = sum(latencies) * 0.25
+                deadline = min(deadline, timeit.default_timer() + grace)
+
+        # Pingers still probing after an early selection would otherwise
+        # keep connecting to servers during the download and upload tests
+        for pinger in pingers:
+            pinger.stop()
+        deadline = timeit.default_timer() + 1
+        for pinger in pingers:
+            while thread_is_alive(pinger) and timeit.default_timer() < deadline:
+                pinger.join(0.1)
+
+        return self._set_best_server(results)
+
+    def _set_best_server(self, results):
+        """Record the server with the lowest score out of ``results``, a
+        list of ``(avg, server, latencies)`` tuples, as the best server
+        """
 
-            avg = round((sum(cum) / 6) * 1000.0, 3)
-            results[avg] = server
+        printer(
+            "Latency results:\n%r"
+            % [(avg, server["id"], latencies) for avg, server, latencies in results],
+            debug=True,
+        )
 
-        try:
-            fastest = sorted(results.keys())[0]
-        except IndexError:
+        if not results:
             raise SpeedtestBestServerFailure(
                 "Unable to connect to servers to " "test latency."
             )
-        best = results[fastest]
+        results.sort(key=lambda result: result[0])
+        self.ranked = []
+        for avg, server, latencies in results:
+            if latencies:
+                server["latency"] = avg
+                self.ranked.append(server)
+        fastest, best, latencies = results[0]
         best["latency"] = fastest
 
         self.results.ping = fastest
+        self.results.latency = latency_stats(latencies)
         self.results.server = best
 
         self._best.update(best)
         printer("Best Server:\n%r" % best, debug=True)
+        self._pin_server(best)
         return best
 
-    def download(self, callback=do_nothing, threads=None):
-        """Test download speed against speedtest.net
+    def get_best_servers(self, count=2):
+        """Return up to ``count`` of the servers that answered every
+        ``get_best_server`` probe, best first, ranked by latency
+        """
+
+        if not self.ranked:
+            self.get_best_server()
+        servers = self.ranked[:count] or [self.best]
+        for server in servers:
+            self._pin_server(server)
+        return servers
+
+    def _pin_server(self, server):
+        """Resolve the host of ``server`` once, pinning its addresses for
+        every later connection to it, and record the time the lookup took
+        in ``results.dns``
+        """
+
+        host, port = server_address(server)
+        if host in self.results.dns:
+            return
+        try:
+            self._pin(host, port)
+        except socket.error:
+            printer("Could not resolve %s: %s" % (host, get_exception()), debug=True)
+
+    def _pin(self, host, port):
+        """Pin the addresses of ``host`` and ``port`` and record the time
+        the lookup took in ``results.dns``
+        """
+
+        elapsed, addresses = self._resolver.pin(host, port)
+        self.results.dns[host] = {
+            "time": round(elapsed * 1000.0, 3),
+            "addresses": sorted(set(address[4][0] for address in addresses)),
+        }
+        printer("Pinned %s: %r" % (host, self.results.dns[host]), debug=True)
+
+    def set_family(self, family):
+        """Pin the best server, and every other pinned server, to its
+        addresses of ``family`` only, ``socket.AF_INET`` or
+        ``socket.AF_INET6``, for all later connections to them
+
+        Raises ``SpeedtestAddressFamilyError`` when a server has no address
+        of ``family``. ``reset_family`` undoes it
+        """
+
+        if self._family is None:
+            self._family = (self._resolver.family, dict(self._resolver.pinned))
+        pinned = set(self._resolver.pinned)
+        pinned.add(server_address(self.best))
+        self._resolver.family = family
+        self._resolver.pinned.clear()
+        self.results.dns = {}
+        for host, port in sorted(pinned):
+            try:
+                self._pin(host, port)
+            except socket.error:
+                raise SpeedtestAddressFamilyError(
+                    "%s has no %s address: %s"
+                    % (host, family_name(family), get_exception())
+                )
+
+    def reset_family(self):
+        """Restore the address family and the pinned addresses from before
+        ``set_family``
+        """
+
+        if self._family is None:
+            return
+        self._resolver.family, pinned = self._family
+        self._resolver.pinned.clear()
+        self._resolver.pinned.update(pinned)
+        self._family = None
+
+    def _set_server_throughput(self, direction, servers, shards, elapsed):
+        """Record the bytes transferred with each of ``servers`` during a
+        ``direction`` test over ``elapsed`` seconds, as counted in
+        ``shards``, and the throughput each contributed, in
+        ``results.servers``
+        """
+
+        entries = dict((entry["id"], entry) for entry in self.results.servers)
+        for server, transferred in zip(servers, shards):
+            entry = entries.get(server["id"])
+            if entry is None:
+                entry = {
+                    "id": server["id"],
+                    "sponsor": server.get("sponsor"),
+                    "name": server.get("name"),
+                    "host": server.get("host"),
+                    "latency": server.get("latency"),
+                    "download": 0,
+                    "upload": 0,
+                    "bytes_received": 0,
+                    "bytes_sent": 0,
+                }
+                self.results.servers.append(entry)
+                entries[server["id"]] = entry
+            entry[direction] = (transferred / elapsed) * 8.0
+            entry[("bytes_received", "bytes_sent")[direction == "upload"]] = transferred
+
+    def _transfer(
+        self,
+        worker,
+        requests,
+        max_threads,
+        timeout,
+        callback,
+        keep_alive=False,
+        shutdown_event=None,
+        **kwargs
+    ):
+        """Service ``requests`` with ``run_transfer``, using the opener,
+        source address and, unless one is given, the shutdown event of this
+        instance
+        """
+
+        return run_transfer(
+            worker,
+            requests,
+            max_threads,
+            timeout,
+            callback,
+            opener=self._opener,
+            source_address=self._source_address,
+            socket_timeout=self._timeout,
+            shutdown_event=shutdown_event or self._shutdown_event,
+            keep_alive=keep_alive,
+            resolver=self._resolver,
+            tls=self._tls,
+            **kwargs
+        )
+
+    def _adaptive(self, length, sample_interval, adaptive, tolerance, max_length):
+        """Set up an adaptive test of configured ``length`` seconds
+
+        Returns the length the workers should run for, the
+        ``AdaptiveDuration`` deciding when the test ends, and whether
+        requests should be refilled, the latter two ``None`` unless
+        ``adaptive``
+        """
+
+        if not (adaptive and sample_interval):
+            return length, None, None
+        controller = AdaptiveDuration(
+            sample_interval,
+            length,
+            max_length or length * 2,
+            tolerance=tolerance,
+            shutdown_event=self._shutdown_event,
+        )
+        return controller.max_length, controller, True
+
+    def idle_latency(self, duration=1.0, interval=0.1):
+        """Measure the idle latency to the best server with a
+        ``LatencyProber`` for ``duration`` seconds, as the baseline of the
+        latency under load
+        """
+
+        prober = self._start_prober(interval)
+        timeit.time.sleep(duration)
+        return self._stop_prober(prober, "idle")
+
+    def _start_prober(self, interval=0.1):
+        """Start a ``LatencyProber`` against the best server, probing every
+        ``interval`` seconds
+        """
+
+        prober = LatencyProber(
+            self.best,
+            interval=interval,
+            source_address=self._source_address,
+            timeout=self._timeout,
+            secure=self._secure,
+            shutdown_event=self._shutdown_event,
+            resolver=self._resolver,
+            tls=self._tls,
+        )
+        prober.start()
+        return prober
+
+    def _stop_prober(self, prober, phase):
+        """Stop ``prober``, recording the latency it measured during
+        ``phase`` in ``results.loaded_latency``
+        """
+
+        if prober is None:
+            return None
+        prober.stop()
+        stats = latency_percentiles(prober.samples)
+        if prober.failed:
+            stats["failed"] = prober.failed
+        self.results.loaded_latency[phase] = stats
+        return stats
+
+    def _set_throughput(
+        self, direction, samples, sample_interval, controller=None, ramp=None
+    ):
+        """Record ``throughput_stats`` of the ``samples`` of a ``direction``
+        test in the results, with the outcome of an adaptive ``controller``
+        and of a concurrency ``ramp``
+        """
+
+        stats = throughput_stats(samples, sample_interval)
+        if controller:
+            stats["adaptive"] = {
+                "reason": controller.reason,
+                "length": round(controller.elapsed, 3),
+            }
+        if ramp:
+            stats["ramp"] = {
+                "streams": ramp.streams,
+                "steps": [[streams, rate] for streams, rate in ramp.steps],
+            }
+        self.results.throughput[direction] = stats
+
+    def _transfer_processes(
+        self, direction, items, processes, max_threads, length, callback, **kwargs
+    ):
+        """Split the ``(i, url)`` download or ``(i, size)`` upload ``items``
+        round robin across ``processes`` ``SpeedtestProcess`` workers,
+        sharing ``max_threads`` threads between them
+
+        The workers start transferring together, once every one of them has
+        built its requests. Any additional keyword arguments are passed
+        through to ``SpeedtestProcess``
+
+        Returns the start and stop time of the transfer, the number of
+        bytes transferred by all of the workers, and the sum of the running
+        totals they sampled
+        """
+
+        request_count = len(items)
+        processes = max(1, min(processes, request_count))
+        threads = max(1, -(-max_threads // processes))
+        barrier = multiprocessing.Barrier(processes + 1)
+
+        pool = []
+        conns = []
+        for p in range(processes):
+            conn, child_conn = multiprocessing.Pipe(False)
+            process = SpeedtestProcess(
+                child_conn,
+                barrier,
+                direction,
+                self.best["url"],
+                items[p::processes],
+                length,
+                threads,
+                source_address=self._source_address,
+                timeout=self._timeout,
+                secure=self._secure,
+                resolver=self._resolver,
+                tls=self._tls,
+                **kwargs
+            )
+            process.start()
+            child_conn.close()
+            pool.append(process)
+            conns.append(conn)
+
+        try:
+            barrier.wait(PROCESS_START_TIMEOUT)
+        except threading.BrokenBarrierError:
+            for process in pool:
+                process.terminate()
+            raise SpeedtestProcessFailure(
+                "%d worker processes did not start within %d seconds"
+                % (processes, PROCESS_START_TIMEOUT)
+            )
+
+        start = timeit.default_timer()
+        transferred = 0
+        finished = 0
+        samples = array.array("d")
+        while conns:
+            if event_is_set(self._shutdown_event):
+                for process in pool:
+                    process.terminate()
+                break
+            for conn in wait_connections(conns, 0.1):
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    # The worker exited without reporting its byte count
+                    message = (0, [], [])
+                if message is None:
+                    callback(finished, request_count, end=True)
+                    finished += 1
+                    continue
+                total, worker_samples, handshakes = message
+                self._tls.handshakes.extend(handshakes)
+                transferred += total
+                conns.remove(conn)
+                conn.close()
+                # Running totals, a worker that stopped early holds its last
+                if len(worker_samples) > len(samples):
+                    last = samples and samples[-1] or 0.0
+                    samples.extend([last] * (len(worker_samples) - len(samples)))
+                last = 0.0
+                for k in range(len(samples)):
+                    if k < len(worker_samples):
+                        last = worker_samples[k]
+                    samples[k] += last
+        stop = timeit.default_timer()
+
+        for process in pool:
+            while process.is_alive():
+                process.join(0.1)
+
+        return start, stop, transferred, samples
+
+    @profiled("download")
+    def download(
+        self,
+        callback=do_nothing,
+        threads=None,
+        keep_alive=False,
+        buffer_size=65536,
+        processes=1,
+        sample_interval=0.1,
+        adaptive=False,
+        tolerance=0.05,
+        max_length=None,
+        ramp=False,
+        max_streams=32,
+        bucket=None,
+        loaded_latency=False,
+        servers=None,
+    ):
+        """Test download speed against speedtest.net
 
         A ``threads`` value of ``None`` will fall back to those dictated
         by the speedtest.net configuration
+
+        With ``keep_alive`` each thread reuses a single connection to the
+        server for all of its requests. ``buffer_size`` is the size in bytes
+        of the receive buffer used by each thread. With more than one of
+        ``processes`` the requests and threads are split across that many
+        worker processes
+
+        The bytes received are sampled every ``sample_interval`` seconds,
+        summarized by ``throughput_stats`` in ``results.throughput``. A
+        ``sample_interval`` of ``0`` disables sampling
+
+        With ``adaptive``, which requires sampling and a single process,
+        the length of the test is decided by ``AdaptiveDuration`` with
+        ``tolerance``, up to ``max_length`` seconds, which defaults to
+        twice the configured length
+
+        With ``ramp``, which also requires sampling and a single process,
+        ``threads`` is replaced by a ``ConcurrencyRamp`` growing the number
+        of threads up to ``max_streams``
+
+        A ``TokenBucket`` given as ``bucket`` caps the bytes and rate of a
+        single process test, its outcome recorded in ``results.cap``
+
+        With ``loaded_latency`` a ``LatencyProber`` measures the latency to
+        the server for the duration of the test, recorded in
+        ``results.loaded_latency``
+
+        With a list of more than one of ``servers``, such as from
+        ``get_best_servers``, a single process test spreads its requests
+        and threads across all of them at once. The throughput is their
+        aggregate, and the share of each server is recorded in
+        ``results.servers``
         """
 
+        if processes > 1 or not servers:
+            servers = [self.best]
+
+        def url(server, size):
+            return "%s/random%sx%s.jpg" % (os.path.dirname(server["url"]), size, size)
+
         urls = []
         for size in self.config["sizes"]["download"]:
             for _ in range(0, self.config["counts"]["download"]):
-                urls.append(
-                    "%s/random%sx%s.jpg"
-                    % (os.path.dirname(self.best["url"]), size, size)
-                )
-
-        request_count = len(urls)
-        requests = []
-        for i, url in enumerate(urls):
-            requests.append(build_request(url, bump=i, secure=self._secure))
+                urls.append(url(servers[len(urls) % len(servers)], size))
 
         max_threads = threads or self.config["threads"]["download"]
-        in_flight = {"threads": 0}
-
-        def producer(q, requests, request_count):
-            for i, request in enumerate(requests):
-                thread = HTTPDownloader(
-                    i,
-                    request,
-                    start,
-                    self.config["length"]["download"],
-                    opener=self._opener,
-                    shutdown_event=self._shutdown_event,
+        prober = loaded_latency and self._start_prober() or None
+        sampler = None
+        controller = None
+        if ramp and sample_interval and processes == 1:
+            ramp = ConcurrencyRamp(sample_interval, maximum=max_streams)
+        else:
+            ramp = None
+        if processes > 1:
+            (
+                start,
+                stop,
+                self.results.bytes_received,
+                samples,
+            ) = self._transfer_processes(
+                "download",
+                list(enumerate(urls)),
+                processes,
+                max_threads,
+                self.config["length"]["download"],
+                callback,
+                keep_alive=keep_alive,
+                buffer_size=buffer_size,
+                sample_interval=sample_interval,
+            )
+        else:
+            length, controller, refill = self._adaptive(
+                self.config["length"]["download"],
+                sample_interval,
+                adaptive,
+                tolerance,
+                max_length,
+            )
+            if sample_interval:
+                sampler = ThroughputSampler(
+                    sample_interval,
+                    listeners=[lst for lst in (controller, ramp) if lst],
                 )
-                while in_flight["threads"] >= max_threads:
-                    timeit.time.sleep(0.001)
-                thread.start()
-                q.put(thread, True)
-                in_flight["threads"] += 1
-                callback(i, request_count, start=True)
-
-        finished = []
-
-        def consumer(q, request_count):
-            _is_alive = thread_is_alive
-            while len(finished) < request_count:
-                thread = q.get(True)
-                while _is_alive(thread):
-                    thread.join(timeout=0.001)
-                in_flight["threads"] -= 1
-                finished.append(sum(thread.result))
-                callback(thread.i, request_count, end=True)
-
-        q = Queue(max_threads)
-        prod_thread = threading.Thread(
-            target=producer, args=(q, requests, request_count)
-        )
-        cons_thread = threading.Thread(target=consumer, args=(q, request_count))
-        start = timeit.default_timer()
-        prod_thread.start()
-        cons_thread.start()
-        _is_alive = thread_is_alive
-        while _is_alive(prod_thread):
-            prod_thread.join(timeout=0.001)
-        while _is_alive(cons_thread):
-            cons_thread.join(timeout=0.001)
+            requests = []
+            for i, request_url in enumerate(urls):
+                requests.append(build_request(request_url, bump=i, secure=self._secure))
+            shards = len(servers) > 1 and [0] * len(servers) or None
+
+            if refill:
+                size = self.config["sizes"]["download"][-1]
+
+                def refill(i, shard):
+                    if bucket and bucket.exhausted:
+                        return None
+                    return build_request(
+                        url(servers[shard], size), bump=i, secure=self._secure
+                    )
 
-        stop = timeit.default_timer()
-        self.results.bytes_received = sum(finished)
+            start, finished = self._transfer(
+                HTTPDownloader,
+                requests,
+                max_threads,
+                length,
+                callback,
+                keep_alive=keep_alive,
+                sampler=sampler,
+                refill=refill,
+                ramp=ramp,
+                shards=shards,
+                profile=self.profile and self.profile.transfer("download"),
+                shutdown_event=controller and controller.stop_event,
+                buffer_size=buffer_size,
+                bucket=bucket,
+            )
+
+            stop = timeit.default_timer()
+            self.results.bytes_received = sum(finished)
+            samples = sampler and sampler.samples
+            if shards:
+                self._set_server_throughput("download", servers, shards, stop - start)
+        self._stop_prober(prober, "download")
+        if sample_interval:
+            self._set_throughput("download", samples, sample_interval, controller, ramp)
+        if bucket:
+            self.results.cap["download"] = bucket.dict()
         self.results.download = (self.results.bytes_received / (stop - start)) * 8.0
         if self.results.download > 100000:
             self.config["threads"]["upload"] = 8
         return self.results.download
 
-    def upload(self, callback=do_nothing, pre_allocate=True, threads=None):
+    @profiled("upload")
+    def upload(
+        self,
+        callback=do_nothing,
+        pre_allocate=True,
+        threads=None,
+        keep_alive=False,
+        shared_payload=False,
+        processes=1,
+        sample_interval=0.1,
+        adaptive=False,
+        tolerance=0.05,
+        max_length=None,
+        ramp=False,
+        max_streams=32,
+        bucket=None,
+        loaded_latency=False,
+        servers=None,
+    ):
         """Test upload speed against speedtest.net
 
         A ``threads`` value of ``None`` will fall back to those dictated
         by the speedtest.net configuration
+
+        With ``keep_alive`` each thread reuses a single connection to the
+        server for all of its requests. With ``shared_payload`` a single
+        payload of the largest upload size is built, and every request is
+        served from a zero copy slice of it, bounding memory use by the
+        largest size instead of the number of requests. With more than one
+        of ``processes`` the requests and threads are split across that
+        many worker processes
+
+        The bytes sent are sampled every ``sample_interval`` seconds,
+        summarized by ``throughput_stats`` in ``results.throughput``. A
+        ``sample_interval`` of ``0`` disables sampling
+
+        ``adaptive``, ``tolerance``, ``max_length``, ``ramp``,
+        ``max_streams``, ``bucket``, ``loaded_latency`` and ``servers`` are
+        as for ``download``
         """
 
+        if processes > 1 or not servers:
+            servers = [self.best]
+
         sizes = []
 
         for size in self.config["sizes"]["upload"]:
@@ -1665,82 +4363,838 @@ class Speedtest(object):
         # request_count = len(sizes)
         request_count = self.config["upload_max"]
 
-        requests = []
-        for i, size in enumerate(sizes):
-            # We set ``0`` for ``start`` and handle setting the actual
-            # ``start`` in ``HTTPUploader`` to get better measurements
-            data = HTTPUploaderData(
-                size,
-                0,
+        max_threads = threads or self.config["threads"]["upload"]
+        prober = loaded_latency and self._start_prober() or None
+        sampler = None
+        controller = None
+        if ramp and sample_interval and processes == 1:
+            ramp = ConcurrencyRamp(sample_interval, maximum=max_streams)
+        else:
+            ramp = None
+        if processes > 1:
+            start, stop, self.results.bytes_sent, samples = self._transfer_processes(
+                "upload",
+                list(enumerate(sizes))[:request_count],
+                processes,
+                max_threads,
                 self.config["length"]["upload"],
-                shutdown_event=self._shutdown_event,
+                callback,
+                keep_alive=keep_alive,
+                pre_allocate=pre_allocate,
+                shared_payload=shared_payload,
+                sample_interval=sample_interval,
             )
-            if pre_allocate:
-                data.pre_allocate()
-
-            headers = {"Content-length": size}
-            requests.append(
-                (
-                    build_request(
-                        self.best["url"], data, secure=self._secure, headers=headers
-                    ),
-                    size,
+        else:
+            length, controller, refill = self._adaptive(
+                self.config["length"]["upload"],
+                sample_interval,
+                adaptive,
+                tolerance,
+                max_length,
+            )
+            if sample_interval:
+                sampler = ThroughputSampler(
+                    sample_interval,
+                    listeners=[lst for lst in (controller, ramp) if lst],
                 )
+            shutdown_event = controller and controller.stop_event
+            shards = len(servers) > 1 and [0] * len(servers) or None
+            sizes = sizes[:request_count]
+            if shared_payload and sizes:
+                # Built once, for the refills to slice as well
+                payload = memoryview(HTTPUploaderData.build_payload(max(sizes)))
+            else:
+                payload = None
+            requests = build_upload_requests(
+                [server["url"] for server in servers],
+                sizes,
+                length,
+                secure=self._secure,
+                shutdown_event=shutdown_event or self._shutdown_event,
+                pre_allocate=pre_allocate,
+                shared_payload=shared_payload,
+                bucket=bucket,
+                payload=payload,
             )
 
-        max_threads = threads or self.config["threads"]["upload"]
-        in_flight = {"threads": 0}
-
-        def producer(q, requests, request_count):
-            for i, request in enumerate(requests[:request_count]):
-                thread = HTTPUploader(
-                    i,
-                    request[0],
-                    start,
-                    request[1],
-                    self.config["length"]["upload"],
-                    opener=self._opener,
-                    shutdown_event=self._shutdown_event,
-                )
-                while in_flight["threads"] >= max_threads:
-                    timeit.time.sleep(0.001)
-                thread.start()
-                q.put(thread, True)
-                in_flight["threads"] += 1
-                callback(i, request_count, start=True)
-
-        finished = []
-
-        def consumer(q, request_count):
-            _is_alive = thread_is_alive
-            while len(finished) < request_count:
-                thread = q.get(True)
-                while _is_alive(thread):
-                    thread.join(timeout=0.001)
-                in_flight["threads"] -= 1
-                finished.append(thread.result)
-                callback(thread.i, request_count, end=True)
-
-        q = Queue(threads or self.config["threads"]["upload"])
-        prod_thread = threading.Thread(
-            target=producer, args=(q, requests, request_count)
-        )
-        cons_thread = threading.Thread(target=consumer, args=(q, request_count))
-        start = timeit.default_timer()
-        prod_thread.start()
-        cons_thread.start()
-        _is_alive = thread_is_alive
-        while _is_alive(prod_thread):
-            prod_thread.join(timeout=0.1)
-        while _is_alive(cons_thread):
-            cons_thread.join(timeout=0.1)
+            if refill:
+
+                def refill(i, shard):
+                    if bucket and bucket.exhausted:
+                        return None
+                    return build_upload_requests(
+                        servers[shard]["url"],
+                        sizes[-1:],
+                        length,
+                        secure=self._secure,
+                        shutdown_event=shutdown_event,
+                        pre_allocate=pre_allocate,
+                        shared_payload=shared_payload,
+                        bucket=bucket,
+                        payload=payload,
+                    )[0]
+
+            start, finished = self._transfer(
+                HTTPUploader,
+                requests,
+                max_threads,
+                length,
+                callback,
+                keep_alive=keep_alive,
+                sampler=sampler,
+                refill=refill,
+                ramp=ramp,
+                shards=shards,
+                profile=self.profile and self.profile.transfer("upload"),
+                shutdown_event=shutdown_event,
+            )
 
-        stop = timeit.default_timer()
-        self.results.bytes_sent = sum(finished)
+            stop = timeit.default_timer()
+            self.results.bytes_sent = sum(finished)
+            samples = sampler and sampler.samples
+            if shards:
+                self._set_server_throughput("upload", servers, shards, stop - start)
+        self._stop_prober(prober, "upload")
+        if sample_interval:
+            self._set_throughput("upload", samples, sample_interval, controller, ramp)
+        if bucket:
+            self.results.cap["upload"] = bucket.dict()
         self.results.upload = (self.results.bytes_sent / (stop - start)) * 8.0
         return self.results.upload
 
 
+if asyncio:
+    if hasattr(asyncio, "all_tasks"):
+        all_tasks = asyncio.all_tasks
+    else:
+        all_tasks = asyncio.Task.all_tasks
+
+    class AsyncioHTTPProtocol(asyncio.Protocol):
+        """Minimal HTTP/1.1 client protocol used by ``AsyncioEngine``
+
+        Makes one request at a time over a kept alive connection, counting
+        the response body bytes received and the request body bytes sent.
+        Request bodies are written in pieces, honouring the flow control of
+        the transport
+        """
+
+        chunk_size = 65536
+
+        def __init__(self, loop):
+            self.loop = loop
+            self.transport = None
+            self.reusable = False
+            self.received = 0
+            self.sent = 0
+
+            self._response = None
+            self._head = bytearray()
+            self._in_body = False
+            self._remaining = None
+            self._status = None
+            self._body = b""
+            self._payload = None
+            self._offset = 0
+            self._paused = False
+
+        def connection_made(self, transport):
+            self.transport = transport
+            sock = transport.get_extra_info("socket")
+            if sock is not None:
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                except (OSError, AttributeError):
+                    pass
+
+        def connection_lost(self, exc):
+            self.transport = None
+            self.reusable = False
+            self._payload = None
+            if self._in_body and self._remaining is None and exc is None:
+                # Response delimited by the connection closing
+                self._finish()
+            elif self._response is not None and not self._response.done():
+                self._response.set_exception(
+                    exc or socket.error("Connection closed by server")
+                )
+
+        def pause_writing(self):
+            self._paused = True
+
+        def resume_writing(self):
+            self._paused = False
+            self._write_payload()
+
+        def request(self, head, payload=None):
+            """Send a request made of the ``head`` bytes and an optional
+            ``payload`` body, returning a future resolved with the status
+            and first bytes of the body once the response is complete
+            """
+            self._response = self.loop.create_future()
+            self._head = bytearray()
+            self._in_body = False
+            self._remaining = None
+            self._status = None
+            self._body = b""
+            self.reusable = False
+
+            self.transport.write(head)
+            if payload is not None:
+                self._payload = payload
+                self._offset = 0
+                self._write_payload()
+            return self._response
+
+        def abort(self):
+            """Abort the connection, discounting request body bytes that
+            were never handed to the network
+            """
+            transport = self.transport
+            if transport is None:
+                return
+            self.sent -= transport.get_write_buffer_size()
+            self._payload = None
+            transport.abort()
+
+        def _write_payload(self):
+            while (
+                self._payload is not None
+                and not self._paused
+                and self.transport is not None
+            ):
+                offset = self._offset
+                chunk = self._payload[offset : offset + self.chunk_size]
+                if not len(chunk):
+                    self._payload = None
+                    break
+                self.transport.write(chunk)
+                self._offset = offset + len(chunk)
+                self.sent += len(chunk)
+
+        def data_received(self, data):
+            if self._response is None or self._response.done():
+                return
+            if not self._in_body:
+                self._head.extend(data)
+                end = self._head.find(b"\r\n\r\n")
+                if end < 0:
+                    return
+                data = bytes(self._head[end + 4 :])
+                try:
+                    self._parse_head(bytes(self._head[:end]))
+                except ValueError:
+                    self._response.set_exception(BadStatusLine(bytes(self._head[:end])))
+                    self.abort()
+                    return
+                self._head = bytearray()
+
+            if self._remaining is None:
+                n = len(data)
+            else:
+                n = min(len(data), self._remaining)
+                self._remaining -= n
+            self.received += n
+            if len(self._body) < 16:
+                self._body += data[: 16 - len(self._body)]
+            if self._remaining == 0:
+                self._finish()
+
+        def _parse_head(self, head):
+            lines = head.decode("latin-1").split("\r\n")
+            self._status = int(lines[0].split(None, 2)[1])
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            self._in_body = True
+            self.reusable = headers.get("connection", "").lower() != "close"
+            if "content-length" in headers:
+                self._remaining = int(headers["content-length"])
+            else:
+                self._remaining = None
+                self.reusable = False
+
+        def _finish(self):
+            self._in_body = False
+            if self._response is not None and not self._response.done():
+                self._response.set_result((self._status, self._body))
+
+    class AsyncioTransfer(object):
+        """One concurrent stream of an ``AsyncioEngine`` phase
+
+        Services ``(i, url, payload)`` requests from the shared ``pending``
+        deque one after another, over a kept alive connection, until the
+        deque is empty or the phase ``deadline`` has passed
+        """
+
+        def __init__(self, engine, loop, pending, deadline, on_request, on_done):
+            self.engine = engine
+            self.loop = loop
+            self.pending = pending
+            self.deadline = deadline
+            self.received = 0
+            self.sent = 0
+
+            self._on_request = on_request
+            self._on_done = on_done
+            self._protocol = None
+            self._stopped = False
+
+        def start(self):
+            self._next()
+
+        def stop(self):
+            """Abort any request in flight, ending this stream"""
+            self._stopped = True
+            if self._protocol is not None:
+                self._protocol.abort()
+
+        def _next(self):
+            if (
+                self._stopped
+                or not self.pending
+                or timeit.default_timer() > self.deadline
+                or event_is_set(self.engine.speedtest._shutdown_event)
+            ):
+                self._close()
+                self._on_done(self)
+                return
+            i, url, payload = self.pending.popleft()
+            self._on_request(i, start=True)
+
+            protocol = self._protocol
+            if protocol is not None and protocol.reusable and protocol.transport:
+                self._send(protocol, i, url, payload)
+                return
+
+            self._close()
+            self.engine.connect(url).add_done_callback(
+                lambda connected: self._connected(connected, i, url, payload)
+            )
+
+        def _connected(self, connected, i, url, payload):
+            if connected.cancelled() or connected.exception() is not None:
+                if not connected.cancelled():
+                    printer("ERROR: %r" % connected.exception(), debug=True)
+                self._request_done(i)
+                return
+            self._protocol = connected.result()
+            if self._stopped:
+                self._close()
+                self._request_done(i)
+                return
+            self._send(self._protocol, i, url, payload)
+
+        def _send(self, protocol, i, url, payload):
+            method = ("GET", "POST")[payload is not None]
+            head = self.engine.request_head(method, url, payload)
+            protocol.request(head, payload).add_done_callback(
+                lambda response: self._request_done(i, response)
+            )
+
+        def _request_done(self, i, response=None):
+            if response is not None and not response.cancelled():
+                if response.exception() is not None:
+                    printer("ERROR: %r" % response.exception(), debug=True)
+            self._on_request(i, end=True)
+            self._next()
+
+        def transferred(self):
+            """Return the bytes received and sent so far by this stream"""
+            protocol = self._protocol
+            if protocol is None:
+                return self.received, self.sent
+            return self.received + protocol.received, self.sent + protocol.sent
+
+        def _close(self):
+            protocol = self._protocol
+            self._protocol = None
+            if protocol is None:
+                return
+            self.received += protocol.received
+            self.sent += protocol.sent
+            if protocol.transport is not None:
+                protocol.transport.close()
+
+    class AsyncioEngine(object):
+        """Alternative measurement engine running the ping, download and
+        upload phases of a ``Speedtest`` as event driven streams on an
+        asyncio event loop, instead of with a thread per stream
+
+        ``concurrency`` is the number of concurrent streams, falling back
+        to the thread counts of the speedtest.net configuration. Results
+        are recorded in the ``SpeedtestResults`` of ``speedtest``
+        """
+
+        def __init__(self, speedtest, concurrency=None):
+            self.speedtest = speedtest
+            self.concurrency = concurrency
+            self.user_agent = build_user_agent()
+
+            if speedtest._source_address:
+                self._local_addr = (speedtest._source_address, 0)
+            else:
+                self._local_addr = None
+            self._ssl_context = None
+            self._loop = None
+
+        @property
+        def results(self):
+            return self.speedtest.results
+
+        @property
+        def profile(self):
+            return self.speedtest.profile
+
+        def _run(self, future_factory):
+            loop = asyncio.new_event_loop()
+            self._loop = loop
+            try:
+                return loop.run_until_complete(future_factory(loop))
+            finally:
+                # Tasks left pending, such as the connections of probes
+                # abandoned by an early server selection, are cancelled
+                # rather than destroyed along with the loop
+                tasks = [task for task in all_tasks(loop) if not task.done()]
+                for task in tasks:
+                    task.cancel()
+                if tasks:
+                    loop.run_until_complete(
+                        asyncio.gather(*tasks, return_exceptions=True)
+                    )
+                # One more iteration runs the callbacks closing the sockets of
+                # aborted connections
+                loop.run_until_complete(asyncio.sleep(0))
+                self._loop = None
+                loop.close()
+
+        def connect(self, url, timeout=None):
+            """Open a connection to the host of ``url``, returning a future
+            resolved with its ``AsyncioHTTPProtocol``
+            """
+            loop = self._loop
+            urlparts = urlparse(url)
+            kwargs = {}
+            if urlparts.scheme == "https":
+                if self._ssl_context is None:
+                    self._ssl_context = (
+                        self.speedtest._tls.context or ssl.create_default_context()
+                    )
+                kwargs["ssl"] = self._ssl_context
+                kwargs["server_hostname"] = urlparts.hostname
+                port = urlparts.port or 443
+            else:
+                port = urlparts.port or 80
+            if self._local_addr:
+                kwargs["local_addr"] = self._local_addr
+            host = urlparts.hostname
+            pinned = self.speedtest._resolver.pinned.get((host, port))
+            if pinned:
+                kwargs["family"] = pinned[0][0]
+                host = pinned[0][4][0]
+
+            protocol = AsyncioHTTPProtocol(loop)
+            task = loop.create_task(
+                loop.create_connection(lambda: protocol, host, port, **kwargs)
+            )
+            handle = loop.call_later(timeout or self.speedtest._timeout, task.cancel)
+            connected = loop.create_future()
+
+            def done(task):
+                handle.cancel()
+                if connected.done():
+                    return
+                if task.cancelled():
+                    connected.set_exception(socket.timeout("Connection timed out"))
+                elif task.exception() is not None:
+                    connected.set_exception(task.exception())
+                else:
+                    connected.set_result(protocol)
+
+            task.add_done_callback(done)
+            return connected
+
+        def request_head(self, method, url, payload=None):
+            urlparts = urlparse(url)
+            path = urlparts.path or "/"
+            if urlparts.query:
+                path = "%s?%s" % (path, urlparts.query)
+            lines = [
+                "%s %s HTTP/1.1" % (method, path),
+                "Host: %s" % urlparts.netloc,
+                "User-Agent: %s" % self.user_agent,
+                "Cache-Control: no-cache",
+                "Accept-Encoding: identity",
+            ]
+            if payload is not None:
+                lines.append("Content-Type: application/x-www-form-urlencoded")
+                lines.append("Content-Length: %d" % len(payload))
+            return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        @profiled("get_best_server")
+        def get_best_server(self, servers=None):
+            """Perform a speedtest.net "ping" of ``servers`` concurrently,
+            with the same selection as ``Speedtest.get_best_server``
+            """
+
+            speedtest = self.speedtest
+            if not servers:
+                if not speedtest.closest:
+                    speedtest.get_closest_servers()
+                servers = speedtest.closest
+
+            count = 3
+            results = []
+
+            def ping(loop):
+                finished = loop.create_future()
+                state = {"remaining": len(servers), "answered": False}
+                protocols = set()
+
+                def finish():
+                    if not finished.done():
+                        finished.set_result(None)
+                        # Abort the probes of the servers not waited for
+                        for protocol in list(protocols):
+                            protocol.abort()
+
+                def server_done(server, samples):
+                    avg, latencies = score_latencies(samples, count)
+                    results.append((avg, server, latencies))
+                    state["remaining"] -= 1
+                    if not state["remaining"]:
+                        finish()
+                    elif len(latencies) == count and not state["answered"]:
+                        # Same early selection as Speedtest.get_best_server
+                        state["answered"] = True
+                        loop.call_later(sum(latencies) * 0.25, finish)
+
+                def probe(server, url, samples):
+                    if len(samples) == count or finished.done():
+                        server_done(server, samples)
+                        return
+                    this_url = "%s.%s" % (url, len(samples))
+                    printer("%s %s" % ("GET", this_url), debug=True)
+                    start = timeit.default_timer()
+
+                    def responded(response):
+                        total = timeit.default_timer() - start
+                        if (
+                            not response.cancelled()
+                            and response.exception() is None
+                            and response.result()[0] == 200
+                            and response.result()[1][:9] == b"test=test"
+                        ):
+                            samples.append(total)
+                        else:
+                            samples.append(None)
+                        probe(server, url, samples)
+
+                    def connected(connection):
+                        if connection.exception() is not None:
+                            samples.append(None)
+                            probe(server, url, samples)
+                            return
+                        protocol = connection.result()
+                        if finished.done():
+                            protocol.abort()
+                            samples.append(None)
+                            probe(server, url, samples)
+                            return
+                        protocols.add(protocol)
+                        response = protocol.request(self.request_head("GET", this_url))
+                        timer = loop.call_later(speedtest._timeout, protocol.abort)
+                        response.add_done_callback(lambda _: timer.cancel())
+                        response.add_done_callback(
+                            lambda _: protocols.discard(protocol)
+                        )
+                        response.add_done_callback(
+                            lambda _: protocol.transport and protocol.transport.close()
+                        )
+                        response.add_done_callback(responded)
+
+                    self.connect(this_url).add_done_callback(connected)
+
+                stamp = int(timeit.time.time() * 1000)
+                for server in servers:
+                    url = "%s/latency.txt?x=%s" % (
+                        os.path.dirname(server["url"]),
+                        stamp,
+                    )
+                    probe(server, url, [])
+                if not servers:
+                    finish()
+                return finished
+
+            self._run(ping)
+            return speedtest._set_best_server(results)
+
+        def _transfer(
+            self,
+            requests,
+            concurrency,
+            length,
+            callback,
+            sample_interval=None,
+            controller=None,
+            refill=None,
+            ramp=None,
+        ):
+            """Service ``requests``, a list of ``(url, payload)`` tuples,
+            with ``concurrency`` streams for at most ``length`` seconds
+
+            With a ``sample_interval`` the bytes received, or sent when
+            uploading, are sampled on the event loop every that many seconds,
+            and passed to an ``AdaptiveDuration`` ``controller``, which ends
+            the transfer. With ``refill``, ``pending`` is kept fed with
+            ``refill(i)`` requests until then. A ``ConcurrencyRamp`` as
+            ``ramp`` replaces ``concurrency``, adding streams as it decides
+
+            Returns the start time, stop time, streams and samples of the
+            transfer
+            """
+
+            progress = {"finished": 0, "queued": len(requests)}
+            pending = collections.deque(
+                (i, url, payload) for i, (url, payload) in enumerate(requests)
+            )
+
+            def on_request(i, start=False, end=False):
+                if start:
+                    if (
+                        refill
+                        and len(pending) < concurrency
+                        and not event_is_set(controller.stop_event)
+                    ):
+                        url, payload = refill(progress["queued"])
+                        pending.append((progress["queued"], url, payload))
+                        progress["queued"] += 1
+                    callback(i, progress["queued"], start=True)
+                else:
+                    callback(progress["finished"], progress["queued"], end=True)
+                    progress["finished"] += 1
+
+            streams = []
+            samples = array.array("d")
+            direction = int(bool(requests) and requests[0][1] is not None)
+
+            def transfer(loop):
+                finished = loop.create_future()
+                deadline = timeit.default_timer() + length
+                active = {"streams": 0}
+
+                def on_done(stream):
+                    active["streams"] -= 1
+                    if not active["streams"] and not finished.done():
+                        finished.set_result(None)
+
+                def timeout():
+                    for stream in streams:
+                        stream.stop()
+
+                def sample(begin):
+                    if finished.done():
+                        return
+                    samples.append(
+                        sum(stream.transferred()[direction] for stream in streams)
+                    )
+                    if ramp:
+                        ramp(samples)
+                    if controller:
+                        controller(samples)
+                        if event_is_set(controller.stop_event):
+                            timeout()
+                            return
+                    loop.call_at(
+                        begin + sample_interval * (len(samples) + 1), sample, begin
+                    )
+
+                loop.call_later(length, timeout)
+                if sample_interval:
+                    begin = loop.time()
+                    loop.call_at(begin + sample_interval, sample, begin)
+
+                def grow(count):
+                    for _ in range(count):
+                        stream = AsyncioTransfer(
+                            self, loop, pending, deadline, on_request, on_done
+                        )
+                        streams.append(stream)
+                        active["streams"] += 1
+                        stream.start()
+
+                if ramp:
+                    ramp.grow = grow
+                grow(max(1, min(ramp and ramp.streams or concurrency, len(pending))))
+                if not streams:
+                    finished.set_result(None)
+                return finished
+
+            start = timeit.default_timer()
+            self._run(transfer)
+            stop = timeit.default_timer()
+            return start, stop, streams, samples
+
+        @profiled("download")
+        def download(
+            self,
+            callback=do_nothing,
+            sample_interval=0.1,
+            adaptive=False,
+            tolerance=0.05,
+            max_length=None,
+            ramp=False,
+            max_streams=32,
+            loaded_latency=False,
+        ):
+            """Test download speed against speedtest.net
+
+            The bytes received are sampled every ``sample_interval``
+            seconds, and ``adaptive``, ``tolerance``, ``max_length``,
+            ``ramp``, ``max_streams`` and ``loaded_latency`` are as by
+            ``Speedtest.download``
+            """
+
+            speedtest = self.speedtest
+            config = speedtest.config
+            requests = []
+            i = 0
+            for size in config["sizes"]["download"]:
+                for _ in range(0, config["counts"]["download"]):
+                    url = "%s/random%sx%s.jpg" % (
+                        os.path.dirname(speedtest.best["url"]),
+                        size,
+                        size,
+                    )
+                    request = build_request(url, bump=i, secure=speedtest._secure)
+                    requests.append((request.get_full_url(), None))
+                    i += 1
+
+            length, controller, refill = speedtest._adaptive(
+                config["length"]["download"],
+                sample_interval,
+                adaptive,
+                tolerance,
+                max_length,
+            )
+            if refill:
+
+                def refill(i):
+                    request = build_request(
+                        requests[-1][0], bump=i, secure=speedtest._secure
+                    )
+                    return request.get_full_url(), None
+
+            concurrency = self.concurrency or config["threads"]["download"]
+            if ramp and sample_interval:
+                ramp = ConcurrencyRamp(sample_interval, maximum=max_streams)
+            else:
+                ramp = None
+            prober = loaded_latency and speedtest._start_prober() or None
+            start, stop, streams, samples = self._transfer(
+                requests,
+                concurrency,
+                length,
+                callback,
+                sample_interval=sample_interval,
+                controller=controller,
+                refill=refill,
+                ramp=ramp,
+            )
+            speedtest._stop_prober(prober, "download")
+            if sample_interval:
+                speedtest._set_throughput(
+                    "download", samples, sample_interval, controller, ramp
+                )
+
+            self.results.bytes_received = sum(stream.received for stream in streams)
+            self.results.download = (self.results.bytes_received / (stop - start)) * 8.0
+            if self.results.download > 100000:
+                config["threads"]["upload"] = 8
+            return self.results.download
+
+        @profiled("upload")
+        def upload(
+            self,
+            callback=do_nothing,
+            sample_interval=0.1,
+            adaptive=False,
+            tolerance=0.05,
+            max_length=None,
+            ramp=False,
+            max_streams=32,
+            loaded_latency=False,
+        ):
+            """Test upload speed against speedtest.net
+
+            Every request is served from a slice of a single shared payload.
+            The bytes sent are sampled every ``sample_interval`` seconds, and
+            ``adaptive``, ``tolerance``, ``max_length``, ``ramp``,
+            ``max_streams`` and ``loaded_latency`` are as by
+            ``Speedtest.upload``
+            """
+
+            speedtest = self.speedtest
+            config = speedtest.config
+            sizes = []
+            for size in config["sizes"]["upload"]:
+                for _ in range(0, config["counts"]["upload"]):
+                    sizes.append(size)
+            sizes = sizes[: config["upload_max"]]
+
+            if sizes:
+                payload = memoryview(HTTPUploaderData.build_payload(max(sizes)))
+            else:
+                payload = memoryview(b"")
+            requests = []
+            for i, size in enumerate(sizes):
+                request = build_request(
+                    speedtest.best["url"], bump=i, secure=speedtest._secure
+                )
+                requests.append((request.get_full_url(), payload[:size]))
+
+            length, controller, refill = speedtest._adaptive(
+                config["length"]["upload"],
+                sample_interval,
+                adaptive,
+                tolerance,
+                max_length,
+            )
+            if refill:
+
+                def refill(i):
+                    request = build_request(
+                        speedtest.best["url"], bump=i, secure=speedtest._secure
+                    )
+                    return request.get_full_url(), payload[: sizes[-1]]
+
+            concurrency = self.concurrency or config["threads"]["upload"]
+            if ramp and sample_interval:
+                ramp = ConcurrencyRamp(sample_interval, maximum=max_streams)
+            else:
+                ramp = None
+            prober = loaded_latency and speedtest._start_prober() or None
+            start, stop, streams, samples = self._transfer(
+                requests,
+                concurrency,
+                length,
+                callback,
+                sample_interval=sample_interval,
+                controller=controller,
+                refill=refill,
+                ramp=ramp,
+            )
+            speedtest._stop_prober(prober, "upload")
+            if sample_interval:
+                speedtest._set_throughput(
+                    "upload", samples, sample_interval, controller, ramp
+                )
+
+            self.results.bytes_sent = sum(stream.sent for stream in streams)
+            self.results.upload = (self.results.bytes_sent / (stop - start)) * 8.0
+            return self.results.upload
+
+
 def ctrl_c(shutdown_event):
     """Catch Ctrl-C key sequence and set a SHUTDOWN_EVENT for our threaded
     operations
@@ -1875,7 +5329,13 @@ def parse_args():
         help="Exclude a server from selection. Can be " "supplied multiple times",
     )
     parser.add_argument("--mini", help="URL of the Speedtest Mini server")
-    parser.add_argument("--source", help="Source IP address to bind to")
+    parser.add_argument(
+        "--source",
+        type=PARSER_TYPE_STR,
+        action="append",
+        help="Source IP address to bind to. Can be supplied multiple times "
+        "to test several uplinks, each with its own server selection",
+    )
     parser.add_argument(
         "--timeout",
         default=10,
@@ -1900,6 +5360,244 @@ def parse_args():
         "insufficient memory, use this option to avoid a "
         "MemoryError",
     )
+    parser.add_argument(
+        "--shared-payload",
+        action="store_true",
+        default=False,
+        help="Serve every upload request from a single shared buffer "
+        "instead of pre allocating data per request. Bounds upload "
+        "memory use by the largest upload size",
+    )
+    parser.add_argument(
+        "--keep-alive",
+        action="store_true",
+        default=False,
+        help="Reuse a single connection per thread for all download and "
+        "upload requests, instead of connecting for every request. "
+        "Connections are made directly to the server, bypassing any proxy",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        default=64,
+        type=PARSER_TYPE_INT,
+        help="Size in KiB of the receive buffer used by each download "
+        "thread. Larger buffers reduce overhead on fast links. Default 64",
+    )
+    parser.add_argument(
+        "--sample-interval",
+        default=100,
+        type=PARSER_TYPE_INT,
+        help="Interval in milliseconds at which throughput is sampled "
+        "during the download and upload tests, for the steady state "
+        "throughput and samples in the JSON output. 0 disables sampling. "
+        "Default 100",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        default=False,
+        help="End the download and upload tests early once throughput is "
+        "stable, and extend them while it is still climbing. Requires "
+        "throughput sampling",
+    )
+    parser.add_argument(
+        "--adaptive-tolerance",
+        default=5.0,
+        type=PARSER_TYPE_FLOAT,
+        help="Percentage within which throughput must hold for an adaptive "
+        "test to end early. Default 5",
+    )
+    parser.add_argument(
+        "--adaptive-max-length",
+        default=0,
+        type=PARSER_TYPE_FLOAT,
+        help="Maximum length in seconds an adaptive test is extended to. "
+        "Default is twice the configured test length",
+    )
+    parser.add_argument(
+        "--ramp",
+        action="store_true",
+        default=False,
+        help="Start the download and upload tests with a single stream, "
+        "doubling the streams while throughput keeps rising, instead of "
+        "using the configured thread counts. Requires throughput sampling",
+    )
+    parser.add_argument(
+        "--ramp-max-streams",
+        default=32,
+        type=PARSER_TYPE_INT,
+        help="Maximum number of streams --ramp grows to. Default 32",
+    )
+    parser.add_argument(
+        "--loaded-latency",
+        action="store_true",
+        default=False,
+        help="Measure latency while idle and during the download and upload "
+        "tests, over a dedicated connection, and grade the bufferbloat",
+    )
+    parser.add_argument(
+        "--max-bytes",
+        default=0,
+        type=PARSER_TYPE_INT,
+        help="Total number of bytes the download and upload tests may "
+        "transfer. The download test may use half, the upload test the "
+        "rest. A test ends early once its share is used. Default 0 "
+        "(unlimited)",
+    )
+    parser.add_argument(
+        "--max-rate",
+        default=0,
+        type=PARSER_TYPE_FLOAT,
+        help="Limit the download and upload tests to this rate, in "
+        "megabits per second, or megabytes per second with --bytes. "
+        "Default 0 (unlimited)",
+    )
+    parser.add_argument(
+        "--multi-server",
+        default=1,
+        type=PARSER_TYPE_INT,
+        help="Run the download and upload tests against this many of the "
+        "lowest latency servers at once, reporting their aggregate and "
+        "per server throughput. Default 1",
+    )
+    parser.add_argument(
+        "--dual-stack",
+        action="store_true",
+        default=False,
+        help="Measure the latency, download and upload against the best "
+        "server over both IPv4 and IPv6, and report them side by side",
+    )
+    parser.add_argument(
+        "--source-schedule",
+        choices=("staggered", "concurrent"),
+        default="staggered",
+        help="With several --source addresses, test them one after another "
+        "(staggered) or all at once (concurrent). Default staggered",
+    )
+    parser.add_argument(
+        "--processes",
+        default=1,
+        type=PARSER_TYPE_INT,
+        help="Split the download and upload tests across this many worker "
+        "processes, to avoid being bound by a single interpreter on fast "
+        "links. Default 1",
+    )
+    parser.add_argument(
+        "--engine",
+        default="threads",
+        choices=("threads", "asyncio"),
+        help="Engine used to run the ping, download and upload tests. "
+        "asyncio runs every stream on a single event loop, with kept alive "
+        "connections made directly to the server. Default threads",
+    )
+    parser.add_argument(
+        "--concurrency",
+        default=None,
+        type=PARSER_TYPE_INT,
+        help="Number of concurrent streams used by the asyncio engine. "
+        "Default is the thread count of the speedtest.net configuration",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Record the wall and CPU time of each phase of the test, and "
+        "the thread start up, time to first response and bytes of each "
+        "transfer thread, in the profile section of the --json output. Per "
+        "thread details require --engine threads and a single process",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        default=0,
+        type=PARSER_TYPE_INT,
+        help="Cache the speedtest.net configuration and server list for "
+        "this many seconds, revalidating them once expired. Default 0 "
+        "(disabled)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        type=PARSER_TYPE_STR,
+        help="Directory to store the cache in, which must be owned by the "
+        "current user and not writable by others. Default is a speedtest-cli "
+        "directory in the user cache directory",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        default=False,
+        help="Keep running, testing every --interval seconds with the same "
+        "configuration, server list and best server, and storing the results "
+        "in --store-dir",
+    )
+    parser.add_argument(
+        "--interval",
+        default=3600,
+        type=PARSER_TYPE_INT,
+        help="Seconds between the tests of --daemon. Default 3600",
+    )
+    parser.add_argument(
+        "--revalidate",
+        default=21600,
+        type=PARSER_TYPE_INT,
+        help="Seconds after which --daemon selects the best server again, "
+        "instead of only measuring the latency to it. Default 21600",
+    )
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        default=False,
+        help="Append the results to the rolling store in --store-dir, as "
+        "--daemon does",
+    )
+    parser.add_argument(
+        "--store-dir",
+        default=None,
+        type=PARSER_TYPE_STR,
+        help="Directory of the rolling store of results, which must be owned "
+        "by the current user and not writable by others. Default is a "
+        "speedtest-cli directory in the user cache directory",
+    )
+    parser.add_argument(
+        "--store-size",
+        default=1000,
+        type=PARSER_TYPE_INT,
+        help="Number of results kept in the rolling store. Default 1000",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        default=False,
+        help="Append the results to the binary history in --store-dir",
+    )
+    parser.add_argument(
+        "--query-history",
+        action="store_true",
+        default=False,
+        help="Print the p5, median and p95 of the ping, download and upload "
+        "in the history over the last --query-days, with rolling medians over "
+        "--query-window, as JSON and exit, without running a test",
+    )
+    parser.add_argument(
+        "--query-days",
+        default=7,
+        type=PARSER_TYPE_FLOAT,
+        help="Length of the --query-history window in days. Default 7",
+    )
+    parser.add_argument(
+        "--query-window",
+        default=24,
+        type=PARSER_TYPE_FLOAT,
+        help="Length of the window of the rolling medians of --query-history "
+        "in hours. Default 24",
+    )
+    parser.add_argument(
+        "--latest",
+        action="store_true",
+        default=False,
+        help="Print the latest result in the rolling store as JSON and exit, "
+        "without running a test",
+    )
     parser.add_argument(
         "--version", action="store_true", help="Show the version number and exit"
     )
@@ -1955,6 +5653,381 @@ def printer(string, quiet=False, debug=False, error=False, **kwargs):
         print_(out, **kwargs)
 
 
+class SpeedtestSession(object):
+    """The tests of one ``shell`` run from one source address
+
+    Holds the ``Speedtest`` bound to ``source_address``, its engine and the
+    servers tested against, so that the tests of several source addresses
+    can run side by side, and be repeated by ``--daemon``. Progress is
+    printed unless ``quiet``
+    """
+
+    def __init__(
+        self,
+        args,
+        source_address=None,
+        cache=None,
+        shutdown_event=None,
+        callback=do_nothing,
+        quiet=False,
+    ):
+        self.args = args
+        self.source_address = source_address
+        self.callback = callback
+        self.quiet = quiet
+        self.engine = None
+        self.servers = None
+        self.revalidated = None
+
+        printer("Retrieving speedtest.net configuration...", quiet)
+        try:
+            self.speedtest = Speedtest(
+                source_address=source_address,
+                timeout=args.timeout,
+                secure=args.secure,
+                shutdown_event=shutdown_event,
+                cache=cache,
+                profile=args.profile,
+            )
+        except (ConfigRetrievalError,) + HTTP_ERRORS:
+            printer("Cannot retrieve speedtest configuration", error=True)
+            raise SpeedtestCLIError(get_exception())
+
+    @property
+    def results(self):
+        return self.speedtest.results
+
+    def select(self):
+        """Retrieve the server list and select the best server, or the
+        ``--multi-server`` best servers, to test against
+        """
+
+        args = self.args
+        speedtest = self.speedtest
+        quiet = self.quiet
+
+        printer("Testing from %(isp)s (%(ip)s)..." % speedtest.config["client"], quiet)
+
+        if args.engine == "asyncio":
+            self.engine = AsyncioEngine(
+                speedtest, concurrency=(args.concurrency, 1)[args.single]
+            )
+
+        if not args.mini:
+            printer("Retrieving speedtest.net server list...", quiet)
+            try:
+                speedtest.get_servers(
+                    servers=args.server,
+                    exclude=args.exclude,
+                    limit=max(5, args.multi_server),
+                )
+            except NoMatchedServers:
+                raise SpeedtestCLIError(
+                    "No matched servers: %s" % ", ".join("%s" % s for s in args.server)
+                )
+            except (ServersRetrievalError,) + HTTP_ERRORS:
+                printer("Cannot retrieve speedtest server list", error=True)
+                raise SpeedtestCLIError(get_exception())
+            except InvalidServerIDType:
+                raise SpeedtestCLIError(
+                    "%s is an invalid server type, must "
+                    "be an int" % ", ".join("%s" % s for s in args.server)
+                )
+
+            if args.server and len(args.server) == 1:
+                printer("Retrieving information for the selected server...", quiet)
+            else:
+                printer("Selecting best server based on ping...", quiet)
+            if args.multi_server > 1:
+                speedtest.get_best_server(
+                    speedtest.get_closest_servers(max(5, args.multi_server)),
+                    rank=args.multi_server,
+                )
+            else:
+                (self.engine or speedtest).get_best_server()
+        elif args.mini:
+            (self.engine or speedtest).get_best_server(
+                speedtest.set_mini_server(args.mini)
+            )
+        self.revalidated = timeit.default_timer()
+
+        printer(
+            "Hosted by %(sponsor)s (%(name)s) [%(d)0.2f km]: "
+            "%(latency)s ms" % self.results.server,
+            quiet,
+        )
+
+        if args.multi_server > 1:
+            self.servers = speedtest.get_best_servers(args.multi_server)
+            for server in self.servers[1:]:
+                printer(
+                    "Also testing against %(sponsor)s (%(name)s) [%(d)0.2f km]: "
+                    "%(latency)s ms" % server,
+                    quiet,
+                )
+
+    def run(self):
+        """Run the download and upload tests, returning the results
+
+        With ``--dual-stack`` the latency, download and upload are measured
+        against the best server over IPv4 and then over IPv6, side by side
+        in ``results.dual_stack``. The results of the IPv4 tests are
+        returned, or those of the IPv6 tests when IPv4 failed
+        """
+
+        if not self.args.dual_stack:
+            return self._run()
+
+        speedtest = self.speedtest
+        dual_stack = {}
+        combined = None
+        try:
+            for name, family in (("ipv4", socket.AF_INET), ("ipv6", socket.AF_INET6)):
+                results = speedtest.new_results()
+                try:
+                    speedtest.set_family(family)
+                    printer(
+                        "Testing over %s (%s)..."
+                        % (
+                            family_name(family),
+                            ", ".join(
+                                address
+                                for entry in results.dns.values()
+                                for address in entry["addresses"]
+                            ),
+                        ),
+                        self.quiet,
+                    )
+                    (self.engine or speedtest).get_best_server([speedtest.best])
+                    if not results.latency:
+                        raise SpeedtestAddressFamilyError(
+                            "%s did not answer over %s"
+                            % (server_address(speedtest.best)[0], family_name(family))
+                        )
+                    printer("Ping: %s ms" % results.ping, self.quiet)
+                    self._run()
+                except (SpeedtestException,) + HTTP_ERRORS:
+                    e = get_exception()
+                    printer("%s test failed: %s" % (family_name(family), e), self.quiet)
+                    dual_stack[name] = {"error": "%s" % e}
+                    continue
+                dual_stack[name] = {
+                    "ping": results.ping,
+                    "latency": results.latency,
+                    "download": results.download,
+                    "upload": results.upload,
+                    "bytes_received": results.bytes_received,
+                    "bytes_sent": results.bytes_sent,
+                    "loaded_latency": results.loaded_latency,
+                    "bufferbloat": results.bufferbloat(),
+                    "dns": results.dns,
+                }
+                combined = combined or results
+        finally:
+            # Later runs, and the configuration and server list refreshes
+            # of --daemon, resolve over either address family again
+            speedtest.reset_family()
+
+        if combined is None:
+            raise SpeedtestAddressFamilyError(
+                "Tests failed over both IPv4 and IPv6: %s, %s"
+                % (dual_stack["ipv4"]["error"], dual_stack["ipv6"]["error"])
+            )
+        combined.dual_stack = dual_stack
+        speedtest.results = combined
+        return combined
+
+    def _run(self):
+        """Run the download and upload tests once"""
+
+        args = self.args
+        speedtest = self.speedtest
+        engine = self.engine
+        results = self.results
+        callback = self.callback
+        quiet = self.quiet
+
+        # Throughput sampling, adaptive length and concurrency, and latency
+        # under load, shared by both tests
+        measure = {
+            "sample_interval": args.sample_interval / 1000.0,
+            "adaptive": args.adaptive,
+            "tolerance": args.adaptive_tolerance / 100.0,
+            "max_length": args.adaptive_max_length or None,
+            "ramp": args.ramp,
+            "max_streams": args.ramp_max_streams,
+            "loaded_latency": args.loaded_latency,
+        }
+
+        capped = bool(args.max_bytes or args.max_rate)
+        if args.max_rate:
+            max_rate = args.max_rate * 1000.0 * 1000.0 * args.units[1] / 8.0
+        else:
+            max_rate = None
+        if args.max_bytes and args.upload and args.download:
+            max_download_bytes = args.max_bytes // 2
+        else:
+            max_download_bytes = args.max_bytes or None
+
+        if args.loaded_latency:
+            printer("Measuring idle latency...", quiet)
+            speedtest.idle_latency()
+
+        if args.download:
+            printer("Testing download speed", quiet, end=("", "\n")[bool(DEBUG)])
+            if engine:
+                engine.download(callback=callback, **measure)
+            else:
+                speedtest.download(
+                    callback=callback,
+                    threads=(None, 1)[args.single],
+                    keep_alive=args.keep_alive,
+                    buffer_size=args.buffer_size * 1024,
+                    processes=args.processes,
+                    bucket=capped and TokenBucket(max_download_bytes, max_rate) or None,
+                    servers=self.servers,
+                    **measure
+                )
+            printer(
+                "Download: %0.2f M%s/s"
+                % (
+                    (results.download / 1000.0 / 1000.0) / args.units[1],
+                    args.units[0],
+                ),
+                quiet,
+            )
+            if results.cap.get("download", {}).get("exhausted"):
+                printer("Download test ended early at the --max-bytes budget", quiet)
+        else:
+            printer("Skipping download test", quiet)
+
+        if args.upload:
+            if args.max_bytes:
+                max_upload_bytes = max(0, args.max_bytes - results.bytes_received)
+            else:
+                max_upload_bytes = None
+            printer("Testing upload speed", quiet, end=("", "\n")[bool(DEBUG)])
+            if engine:
+                engine.upload(callback=callback, **measure)
+            else:
+                speedtest.upload(
+                    callback=callback,
+                    pre_allocate=args.pre_allocate,
+                    threads=(None, 1)[args.single],
+                    keep_alive=args.keep_alive,
+                    shared_payload=args.shared_payload,
+                    processes=args.processes,
+                    bucket=capped and TokenBucket(max_upload_bytes, max_rate) or None,
+                    servers=self.servers,
+                    **measure
+                )
+            printer(
+                "Upload: %0.2f M%s/s"
+                % (
+                    (results.upload / 1000.0 / 1000.0) / args.units[1],
+                    args.units[0],
+                ),
+                quiet,
+            )
+            if results.cap.get("upload", {}).get("exhausted"):
+                printer("Upload test ended early at the --max-bytes budget", quiet)
+        else:
+            printer("Skipping upload test", quiet)
+
+        if args.loaded_latency:
+            printer(
+                "Latency: idle %s ms, download %s ms, upload %s ms, bufferbloat %s"
+                % (
+                    results.loaded_latency.get("idle", {}).get("p50", "-"),
+                    results.loaded_latency.get("download", {}).get("p50", "-"),
+                    results.loaded_latency.get("upload", {}).get("p50", "-"),
+                    results.bufferbloat() or "-",
+                ),
+                quiet,
+            )
+
+        for entry in results.servers:
+            printer(
+                "  %s (%s): Download: %0.2f M%s/s, Upload: %0.2f M%s/s"
+                % (
+                    entry["sponsor"],
+                    entry["name"],
+                    (entry["download"] / 1000.0 / 1000.0) / args.units[1],
+                    args.units[0],
+                    (entry["upload"] / 1000.0 / 1000.0) / args.units[1],
+                    args.units[0],
+                ),
+                quiet,
+            )
+
+        printer("Results:\n%r" % results.dict(), debug=True)
+        return results
+
+    def reselect(self):
+        """Start new results for the next ``--daemon`` run, re-pinging the
+        best server, or selecting the best server again once
+        ``--revalidate`` seconds have passed since it last was
+        """
+
+        args = self.args
+        speedtest = self.speedtest
+        speedtest.new_results()
+        try:
+            if args.mini or timeit.default_timer() - self.revalidated < args.revalidate:
+                speedtest.get_best_server([speedtest.best])
+            else:
+                printer("Selecting best server based on ping...", self.quiet)
+                if self.servers:
+                    speedtest.get_best_server(speedtest.closest, rank=args.multi_server)
+                    self.servers = speedtest.get_best_servers(args.multi_server)
+                else:
+                    (self.engine or speedtest).get_best_server(speedtest.closest)
+                self.revalidated = timeit.default_timer()
+                printer(
+                    "Hosted by %(sponsor)s (%(name)s) [%(d)0.2f km]: "
+                    "%(latency)s ms" % self.results.server,
+                    self.quiet,
+                )
+        except (SpeedtestException,) + HTTP_ERRORS:
+            printer("Server selection failed: %s" % get_exception(), error=True)
+
+
+def run_sessions(sessions, name, concurrent=False):
+    """Call the method ``name`` of every ``SpeedtestSession`` in
+    ``sessions``, all at once in their own threads when ``concurrent``,
+    otherwise one after another
+
+    Returns a list of ``(returned, exception)`` tuples in the order of
+    ``sessions``, with the ``SpeedtestException`` or HTTP error raised by
+    a session, if any, in place of what it returned
+    """
+
+    outcomes = [(None, None)] * len(sessions)
+
+    def call(i):
+        try:
+            outcomes[i] = (getattr(sessions[i], name)(), None)
+        except (SpeedtestException,) + HTTP_ERRORS:
+            outcomes[i] = (None, get_exception())
+
+    if not concurrent or len(sessions) == 1:
+        for i in range(len(sessions)):
+            call(i)
+        return outcomes
+
+    pool = []
+    for i in range(len(sessions)):
+        thread = threading.Thread(target=call, args=(i,))
+        thread.daemon = True
+        thread.start()
+        pool.append(thread)
+    for thread in pool:
+        # Join with a timeout so that Ctrl-C is handled meanwhile
+        while thread_is_alive(thread):
+            thread.join(0.1)
+    return outcomes
+
+
 def shell():
     """Run the full speedtest.net test"""
 
@@ -1975,6 +6048,86 @@ def shell():
     if len(args.csv_delimiter) != 1:
         raise SpeedtestCLIError("--csv-delimiter must be a single character")
 
+    if args.buffer_size < 1:
+        raise SpeedtestCLIError("--buffer-size must be at least 1 KiB")
+
+    if args.concurrency is not None and args.concurrency < 1:
+        raise SpeedtestCLIError("--concurrency must be at least 1")
+
+    if args.sample_interval < 0:
+        raise SpeedtestCLIError("--sample-interval must not be negative")
+
+    if args.processes < 1:
+        raise SpeedtestCLIError("--processes must be at least 1")
+
+    if args.processes > 1 and multiprocessing is None:
+        raise SpeedtestCLIError(
+            "multiprocessing is not available. --processes is unavailable"
+        )
+
+    if args.adaptive and not args.sample_interval:
+        raise SpeedtestCLIError("--adaptive requires a --sample-interval")
+
+    if args.adaptive and args.processes > 1:
+        raise SpeedtestCLIError("--adaptive cannot be used with --processes")
+
+    if args.ramp and not args.sample_interval:
+        raise SpeedtestCLIError("--ramp requires a --sample-interval")
+
+    if args.ramp and (args.processes > 1 or args.single):
+        raise SpeedtestCLIError("--ramp cannot be used with --processes or --single")
+
+    if args.ramp_max_streams < 1:
+        raise SpeedtestCLIError("--ramp-max-streams must be at least 1")
+
+    if args.adaptive_tolerance <= 0:
+        raise SpeedtestCLIError("--adaptive-tolerance must be greater than 0")
+
+    if args.max_bytes < 0 or args.max_rate < 0:
+        raise SpeedtestCLIError("--max-bytes and --max-rate must not be negative")
+
+    if (args.max_bytes or args.max_rate) and (
+        args.processes > 1 or args.engine != "threads"
+    ):
+        raise SpeedtestCLIError(
+            "--max-bytes and --max-rate require --engine threads and a "
+            "single process"
+        )
+
+    if args.processes > 1 and args.engine != "threads":
+        raise SpeedtestCLIError("--processes requires --engine threads")
+
+    if args.multi_server < 1:
+        raise SpeedtestCLIError("--multi-server must be at least 1")
+
+    if args.multi_server > 1 and (
+        args.processes > 1 or args.engine != "threads" or args.mini
+    ):
+        raise SpeedtestCLIError(
+            "--multi-server requires --engine threads, a single process and "
+            "no --mini"
+        )
+
+    if args.interval < 1 or args.revalidate < 1:
+        raise SpeedtestCLIError("--interval and --revalidate must be at least 1")
+
+    if args.store_size < 1:
+        raise SpeedtestCLIError("--store-size must be at least 1")
+
+    if args.query_days <= 0 or args.query_window <= 0:
+        raise SpeedtestCLIError("--query-days and --query-window must be positive")
+
+    if args.dual_stack and args.source:
+        raise SpeedtestCLIError("--dual-stack cannot be used with --source")
+
+    if args.history and args.source and len(args.source) > 1:
+        raise SpeedtestCLIError("--history cannot be used with several --source")
+
+    if args.engine == "asyncio" and asyncio is None:
+        raise SpeedtestCLIError(
+            "asyncio is not available. --engine asyncio is unavailable"
+        )
+
     if args.csv_header:
         csv_header(args.csv_delimiter)
 
@@ -2002,120 +6155,207 @@ def shell():
     else:
         callback = print_dots(shutdown_event)
 
-    printer("Retrieving speedtest.net configuration...", quiet)
-    try:
-        speedtest = Speedtest(
-            source_address=args.source, timeout=args.timeout, secure=args.secure
+    if args.daemon or args.store or args.latest:
+        store = SpeedtestStore(args.store_dir, args.store_size)
+    else:
+        store = None
+
+    if args.history or args.query_history:
+        history = SpeedtestHistory(
+            args.store_dir and os.path.join(args.store_dir, "history.bin")
+        )
+    else:
+        history = None
+
+    if args.query_history:
+        printer(
+            json.dumps(
+                history.query(
+                    timeit.time.time() - args.query_days * 86400,
+                    window=args.query_window * 3600,
+                )
+            )
+        )
+        return
+
+    if args.latest:
+        latest = store.latest()
+        if latest is None:
+            raise SpeedtestCLIError("No results stored in %s" % store.path)
+        printer(json.dumps(latest))
+        return
+
+    sources = args.source or [None]
+    multiple = len(sources) > 1
+    concurrent = args.source_schedule == "concurrent"
+
+    if args.cache_ttl > 0:
+        cache = SpeedtestCache(args.cache_dir, args.cache_ttl)
+    else:
+        cache = None
+
+    sessions = []
+    for source in sources:
+        session_cache = cache
+        if multiple:
+            printer("Retrieving speedtest.net configuration for %s..." % source, quiet)
+            # The configuration holds the address and location of the client,
+            # which differ between uplinks
+            if cache:
+                session_cache = SpeedtestCache(
+                    os.path.join(cache.path, re.sub(r"[^\w.]", "_", source)),
+                    cache.ttl,
+                )
+        sessions.append(
+            SpeedtestSession(
+                args,
+                source,
+                cache=session_cache,
+                shutdown_event=shutdown_event,
+                callback=(callback, do_nothing)[multiple],
+                quiet=quiet or multiple,
+            )
         )
-    except (ConfigRetrievalError,) + HTTP_ERRORS:
-        printer("Cannot retrieve speedtest configuration", error=True)
-        raise SpeedtestCLIError(get_exception())
 
     if args.list:
+        speedtest = sessions[0].speedtest
         try:
             speedtest.get_servers()
         except (ServersRetrievalError,) + HTTP_ERRORS:
             printer("Cannot retrieve speedtest server list", error=True)
             raise SpeedtestCLIError(get_exception())
 
-        for _, servers in sorted(speedtest.servers.items()):
-            for server in servers:
-                line = (
-                    "%(id)5s) %(sponsor)s (%(name)s, %(country)s) "
-                    "[%(d)0.2f km]" % server
-                )
-                try:
-                    printer(line)
-                except IOError:
-                    e = get_exception()
-                    if e.errno != errno.EPIPE:
-                        raise
+        for server in speedtest.servers.by_distance(speedtest.lat_lon):
+            line = (
+                "%(id)5s) %(sponsor)s (%(name)s, %(country)s) " "[%(d)0.2f km]" % server
+            )
+            try:
+                printer(line)
+            except IOError:
+                e = get_exception()
+                if e.errno != errno.EPIPE:
+                    raise
         sys.exit(0)
 
-    printer("Testing from %(isp)s (%(ip)s)..." % speedtest.config["client"], quiet)
-
-    if not args.mini:
-        printer("Retrieving speedtest.net server list...", quiet)
-        try:
-            speedtest.get_servers(servers=args.server, exclude=args.exclude)
-        except NoMatchedServers:
-            raise SpeedtestCLIError(
-                "No matched servers: %s" % ", ".join("%s" % s for s in args.server)
-            )
-        except (ServersRetrievalError,) + HTTP_ERRORS:
-            printer("Cannot retrieve speedtest server list", error=True)
-            raise SpeedtestCLIError(get_exception())
-        except InvalidServerIDType:
-            raise SpeedtestCLIError(
-                "%s is an invalid server type, must "
-                "be an int" % ", ".join("%s" % s for s in args.server)
+    if multiple:
+        printer("Selecting the best server for each source address...", quiet)
+    for session, (_, error) in zip(
+        sessions, run_sessions(sessions, "select", concurrent)
+    ):
+        if error is not None:
+            raise error
+        if multiple:
+            client = session.speedtest.config["client"]
+            printer(
+                "%s: Testing from %s (%s), hosted by %s (%s) [%0.2f km]: %s ms"
+                % (
+                    session.source_address,
+                    client["isp"],
+                    client["ip"],
+                    session.results.server["sponsor"],
+                    session.results.server["name"],
+                    session.results.server["d"],
+                    session.results.server["latency"],
+                ),
+                quiet,
             )
 
-        if args.server and len(args.server) == 1:
-            printer("Retrieving information for the selected server...", quiet)
-        else:
-            printer("Selecting best server based on ping...", quiet)
-        speedtest.get_best_server()
-    elif args.mini:
-        speedtest.get_best_server(speedtest.set_mini_server(args.mini))
-
-    results = speedtest.results
-
-    printer(
-        "Hosted by %(sponsor)s (%(name)s) [%(d)0.2f km]: "
-        "%(latency)s ms" % results.server,
-        quiet,
-    )
-
-    if args.download:
-        printer("Testing download speed", quiet, end=("", "\n")[bool(debug)])
-        speedtest.download(callback=callback, threads=(None, 1)[args.single])
-        printer(
-            "Download: %0.2f M%s/s"
-            % ((results.download / 1000.0 / 1000.0) / args.units[1], args.units[0]),
-            quiet,
-        )
-    else:
-        printer("Skipping download test", quiet)
-
-    if args.upload:
-        printer("Testing upload speed", quiet, end=("", "\n")[bool(debug)])
-        speedtest.upload(
-            callback=callback,
-            pre_allocate=args.pre_allocate,
-            threads=(None, 1)[args.single],
-        )
-        printer(
-            "Upload: %0.2f M%s/s"
-            % ((results.upload / 1000.0 / 1000.0) / args.units[1], args.units[0]),
-            quiet,
-        )
-    else:
-        printer("Skipping upload test", quiet)
+    next_run = timeit.default_timer()
+    while 1:
+        if multiple:
+            printer(
+                "Testing %d source addresses %s..."
+                % (len(sessions), ("one after another", "at once")[concurrent]),
+                quiet,
+            )
+        completed = []
+        for session, (results, error) in zip(
+            sessions, run_sessions(sessions, "run", concurrent)
+        ):
+            if error is None:
+                completed.append(results)
+            elif not args.daemon:
+                raise error
+            else:
+                printer(
+                    "Test from %s failed: %s" % (session.source_address or "-", error),
+                    error=True,
+                )
 
-    printer("Results:\n%r" % results.dict(), debug=True)
+        try:
+            if not args.simple and args.share:
+                for results in completed:
+                    results.share()
+
+            if args.simple:
+                for results in completed:
+                    if multiple:
+                        printer("Source: %s" % results.source)
+                    printer(
+                        "Ping: %s ms\nDownload: %0.2f M%s/s\nUpload: %0.2f M%s/s"
+                        % (
+                            results.ping,
+                            (results.download / 1000.0 / 1000.0) / args.units[1],
+                            args.units[0],
+                            (results.upload / 1000.0 / 1000.0) / args.units[1],
+                            args.units[0],
+                        )
+                    )
+            elif args.csv:
+                for results in completed:
+                    printer(results.csv(delimiter=args.csv_delimiter))
+            elif args.json:
+                if multiple:
+                    printer(json.dumps([results.dict() for results in completed]))
+                else:
+                    for results in completed:
+                        printer(results.json())
+            elif multiple:
+                for results in completed:
+                    printer(
+                        "%s: Ping: %s ms, Download: %0.2f M%s/s, "
+                        "Upload: %0.2f M%s/s"
+                        % (
+                            results.source,
+                            results.ping,
+                            (results.download / 1000.0 / 1000.0) / args.units[1],
+                            args.units[0],
+                            (results.upload / 1000.0 / 1000.0) / args.units[1],
+                            args.units[0],
+                        )
+                    )
 
-    if not args.simple and args.share:
-        results.share()
+            if args.share and not machine_format:
+                for results in completed:
+                    if multiple:
+                        printer(
+                            "Share results for %s: %s"
+                            % (results.source, results.share())
+                        )
+                    else:
+                        printer("Share results: %s" % results.share())
+        except (SpeedtestException,) + HTTP_ERRORS:
+            if not args.daemon:
+                raise
+            printer("Test failed: %s" % get_exception(), error=True)
+        else:
+            for results in completed:
+                if store:
+                    store.append(results.dict())
+                if history:
+                    history.append(results)
+        if not args.daemon:
+            break
 
-    if args.simple:
-        printer(
-            "Ping: %s ms\nDownload: %0.2f M%s/s\nUpload: %0.2f M%s/s"
-            % (
-                results.ping,
-                (results.download / 1000.0 / 1000.0) / args.units[1],
-                args.units[0],
-                (results.upload / 1000.0 / 1000.0) / args.units[1],
-                args.units[0],
-            )
-        )
-    elif args.csv:
-        printer(results.csv(delimiter=args.csv_delimiter))
-    elif args.json:
-        printer(results.json())
+        while next_run <= timeit.default_timer():
+            next_run += args.interval
+        while not event_is_set(shutdown_event):
+            remaining = next_run - timeit.default_timer()
+            if remaining <= 0:
+                break
+            timeit.time.sleep(min(remaining, 1))
 
-    if args.share and not machine_format:
-        printer("Share results: %s" % results.share())
+        run_sessions(sessions, "reselect", concurrent)
 
 
 def main():
@@ -0,0 +1,83 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+import all_network_speedtest as speedtest  # noqa: E402
+
+HOUR = 3600.0
+
+
+class _Results:
+    def __init__(self, ping, download, upload):
+        self.server = {"id": "1"}
+        self.ping = ping
+        self.download = download
+        self.upload = upload
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+
+def _history(tmp_path, records):
+    history = speedtest.SpeedtestHistory(str(tmp_path / "history.bin"))
+    for timestamp, ping in records:
+        history.append(_Results(ping, ping * 1000, ping * 100), timestamp)
+    return history
+
+
+def test_history_rolling_window_membership(tmp_path):
+    # Records every 10 hours straddle the edges of 24 hour buckets, which
+    # a sliding window must not depend on
+    history = _history(
+        tmp_path, [(0.0, 10.0), (10 * HOUR, 20.0), (20 * HOUR, 30.0), (30 * HOUR, 40.0)]
+    )
+    summary = history.query(0.0, window=24 * HOUR)
+
+    assert summary["records"] == 4
+    rolling = summary["rolling"]
+    assert [entry["timestamp"] for entry in rolling] == [
+        0.0,
+        10 * HOUR,
+        20 * HOUR,
+        30 * HOUR,
+    ]
+    assert [entry["records"] for entry in rolling] == [1, 2, 3, 3]
+    assert [entry["ping"] for entry in rolling] == [10.0, 15.0, 20.0, 30.0]
+    assert rolling[-1]["download"] == 30000.0
+
+
+def test_history_rolling_window_includes_records_before_since(tmp_path):
+    history = _history(tmp_path, [(0.0, 10.0), (20 * HOUR, 30.0), (30 * HOUR, 50.0)])
+    summary = history.query(25 * HOUR, window=24 * HOUR)
+
+    # Only the record after ``since`` is summarized, but its window still
+    # reaches back over the record before it
+    assert summary["records"] == 1
+    assert summary["ping"]["p50"] == 50.0
+    assert summary["latest"]["ping"] == 50.0
+    assert summary["rolling"] == [
+        {
+            "timestamp": 30 * HOUR,
+            "records": 2,
+            "ping": 40.0,
+            "download": 40000.0,
+            "upload": 4000.0,
+        }
+    ]
+
+
+def test_history_rolling_window_edge_is_inclusive(tmp_path):
+    history = _history(tmp_path, [(0.0, 10.0), (24 * HOUR, 20.0)])
+    rolling = history.query(0.0, window=24 * HOUR)["rolling"]
+
+    assert [entry["records"] for entry in rolling] == [1, 2]
+
+
+def test_history_drops_torn_record_before_appending(tmp_path):
+    history = _history(tmp_path, [(float(i), 10.0) for i in range(3)])
+    with open(history.path, "ab") as f:
+        f.write(b"x" * 20)
+    for i in range(3, 6):
+        history.append(_Results(10.0, 1.0, 1.0), float(i))
+
+    assert history.query(0.0)["records"] == 6